@@ -1,11 +1,11 @@
-import urllib.request
-import json
-import requests
 
 from PIL import Image
 from io import BytesIO
 import numpy as np
 from collections import defaultdict
+from typing import List
+from annotation_handling import union_by_id, polygons_from_rings
+from http_client import http_get, ALLEN_API_URL
 
 #%% low level functions specific to Allen dataset
 
@@ -14,27 +14,23 @@ from collections import defaultdict
 def fetch_atlas_metadata( atlas_id ) :
     
     # RMA query to find images for atlas
-    query_url = "http://api.brain-map.org/api/v2/data/query.json?criteria=model::Atlas"
+    query_url = ALLEN_API_URL + "/api/v2/data/query.json?criteria=model::Atlas"
     query_url += ",rma::criteria,[id$eq%d]" % (atlas_id)
     query_url += ",rma::include,structure_graph(ontology),graphic_group_labels"
 
-    webURL = urllib.request.urlopen(query_url)
-    data = webURL.read()
-    JSON_object = json.loads(data.decode('utf-8'))['msg'][0]
+    JSON_object = http_get(query_url).json()['msg'][0]
     return JSON_object
 
 
 def fetch_atlas_images( atlas_metadata ) :
     
     # RMA query to find images for atlas
-    query_url = "http://api.brain-map.org/api/v2/data/query.json?criteria=model::AtlasImage"
+    query_url = ALLEN_API_URL + "/api/v2/data/query.json?criteria=model::AtlasImage"
     # query_url += ",rma::criteria,[annotated$eqtrue]"
     query_url += ",atlas_data_set(atlases[id$eq%d])" % (atlas_metadata['id'])
     query_url += ",rma::options[order$eq'sub_images.section_number'][num_rows$eqall]"
     
-    webURL = urllib.request.urlopen(query_url)
-    data = webURL.read()
-    JSON_object = json.loads(data.decode('utf-8'))['msg']
+    JSON_object = http_get(query_url).json()['msg']
     return JSON_object
 
 
@@ -55,7 +51,7 @@ def get_image_url(atlas_id, img, downsample, annotation=False): #, output_direct
     # image_path = os.path.join( output_directory, '%04d_%d_%s.jpg' % (img['section_number'],img['id'],image_type) )
     #print(image_path)
     
-    image_url  = "http://api.brain-map.org/api/v2/atlas_image_download/%d?" % (img['id'])
+    image_url  = ALLEN_API_URL + "/api/v2/atlas_image_download/%d?" % (img['id'])
     image_url += "downsample=%d" % (downsample)
     image_url += "&annotation=%s" % (annotation_attr)
     image_url += "&atlas=%d" % (atlas_id)
@@ -68,7 +64,7 @@ def get_svg_url(atlas_id, img, graphic_groups, downsample): #, output_directory)
         
         groups_attr = (',').join([str(g) for g in graphic_groups])
                 
-        svg_url  = "http://api.brain-map.org/api/v2/svg/%d?" % (img['id'])
+        svg_url  = ALLEN_API_URL + "/api/v2/svg/%d?" % (img['id'])
         svg_url += "downsample=%d" % (downsample)
         svg_url += "&groups=%s" % (groups_attr)
 
@@ -95,13 +91,37 @@ class AllenHelper:
         self.graphic_groups = fetch_graphic_groups( metadata )
         self.downsample = downsample
 
+        # section number: image record (first one for repeated numbers), sorted numbers for range queries
+        self._img_by_secnum = {}
+        for img in self.images:
+            self._img_by_secnum.setdefault(img['section_number'], img)
+        self.sorted_section_numbers = np.array(sorted(self._img_by_secnum), dtype=np.int64)
+
     def get_section_numbers(self):
         return [elt['section_number'] for elt in self.images]
 
+    def has_section(self, secnum:int):
+        return secnum in self._img_by_secnum
+
     def _get_img(self,secnum:int):
-        secnos = self.get_section_numbers()
-        img = self.images[secnos.index(secnum)]
-        return img
+        if secnum not in self._img_by_secnum:
+            raise ValueError(f'no section {secnum} in atlas {self.atlas_id}')
+        return self._img_by_secnum[secnum]
+
+    def nearest_section(self, secnum):
+        """ closest available section number (lower one on ties), secnum can be a number or an array """
+        secnos = self.sorted_section_numbers
+        query = np.asarray(secnum)
+        idx = np.searchsorted(secnos, query)
+        lower = secnos[np.maximum(idx-1, 0)]
+        upper = secnos[np.minimum(idx, len(secnos)-1)]
+        nearest = np.where(query-lower <= upper-query, lower, upper)
+        return nearest.item() if np.ndim(nearest)==0 else nearest
+
+    def get_sections_between(self, first:int, last:int):
+        """ available section numbers in [first, last] """
+        secnos = self.sorted_section_numbers
+        return secnos[np.searchsorted(secnos, first, 'left'):np.searchsorted(secnos, last, 'right')].tolist()
 
     def get_section_urls(self, secnum:int):
         img = self._get_img(secnum)
@@ -109,30 +129,35 @@ class AllenHelper:
         annot_url = get_svg_url(self.atlas_id, img, self.graphic_groups, self.downsample)
         return image_url, annot_url
 
+    def get_section_urls_many(self, secnums=None):
+        """ {secnum: (image_url, annot_url)} for a list of sections (all by default) """
+        if secnums is None:
+            secnums = self.sorted_section_numbers.tolist()
+        return {secnum:self.get_section_urls(secnum) for secnum in secnums}
+
     def get_sectionimage(self,secnum:int):
         imgurl, annoturl = self.get_section_urls(secnum)
-        req = requests.get(imgurl, timeout=500, stream=True)
+        req = http_get(imgurl)
         im = Image.open(BytesIO(req.content))
         return np.array(im)
     
-    def get_annotation(self, secnum:int):
+    def iter_annotation_shapes(self, secnum:int, chunk_size=1<<16):
+        """ (structure_id, shape) of each svg path, parsed while the svg downloads """
         imgurl, annoturl = self.get_section_urls(secnum)
-        req = requests.get(annoturl, timeout=500)
+        with http_get(annoturl, stream=True) as req:
+            if req.status_code==200:
+                # FIXME: MAGIC: 3 was found empirically 
+                yield from iter_svg_paths_as_shapes(req.iter_content(chunk_size=chunk_size), scale=3/(2**(self.downsample)))
+
+    def get_annotation(self, secnum:int):
+        ontoids, shapes = [], []
+        for ontoid, shp in self.iter_annotation_shapes(secnum):
+            ontoids.append(ontoid)
+            shapes.append(shp)
         
         outdict = {}
-        if req.status_code==200:
-            # FIXME: MAGIC: 3 was found empirically 
-            shapes = get_svg_paths_as_shapes(req.text, scale=3/(2**(self.downsample)))
-
-            for ontoid,shplist in shapes.items():
-                united = None
-                for shp in shplist:
-                    if united is None:
-                        united = shp
-                    else:
-                        united=united.union(shp)
-                        
-                outdict[ontoid] = united
+        if len(ontoids) > 0:
+            outdict = union_by_id(ontoids, shapes)
         return outdict
         
     
@@ -145,9 +170,10 @@ class AllenHelper:
 
 #%% util functions for handling svg, shapely 
 
+import re
+import itertools
 import xml.etree.ElementTree as ET
 # from svgpathtools import parse_path
-from svg.path import parse_path
 import shapely
 
 def make_polyshape(feat, make_valid=False):
@@ -176,37 +202,259 @@ def make_polyshape(feat, make_valid=False):
 #     }
     
 
-def _path_to_coords(path_d, scale):
+_PATH_TOKEN = re.compile(r'([MmLlHhVvCcSsQqTtAaZz])|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+_PATH_NUMARGS = {'M':2, 'L':2, 'H':1, 'V':1, 'C':6, 'S':4, 'Q':4, 'T':2, 'A':7, 'Z':0}
+
+LINE, QUAD, CUBIC, ARC = 0, 1, 2, 3
+
+def parse_path_arrays(path_d:str):
+    """
+    parses an svg path d string once into segment arrays (complex coordinates):
+    kind (N,) LINE/QUAD/CUBIC/ARC, ctrl (N,4) control points (start, ..., end; padded with the end point),
+    arc (N,5) rx, ry, rotation (degrees), large_arc, sweep (for ARC segments),
+    subpath_end (N,) True for the last segment of each subpath
+    """
+    tokens = [(cmd, num) for cmd, num in _PATH_TOKEN.findall(path_d)]
+    kinds, ctrls, arcs, subpath_end = [], [], [], []
+
+    pos = 0
+    cmd = None
+    current = start = 0j
+    last_ctrl, last_cmd = None, None
+
+    def numbers(count, flags=()):
+        nonlocal pos
+        out = []
+        while len(out) < count:
+            _, num = tokens[pos]
+            if len(out) in flags and len(num) > 1 and num[0] in '01': # packed arc flags, e.g. '01'
+                tokens[pos] = ('', num[1:])
+                num = num[0]
+            else:
+                pos += 1
+            out.append(float(num))
+        return out
+
+    def add(kind, ctrl, arc=(0,0,0,0,0)):
+        kinds.append(kind)
+        ctrls.append(ctrl + [ctrl[-1]]*(4-len(ctrl)))
+        arcs.append(arc)
+        subpath_end.append(False)
+
+    while pos < len(tokens):
+        if tokens[pos][0] != '':
+            cmd = tokens[pos][0]
+            pos += 1
+        elif cmd in ('M', 'm'): # implicit lineto after moveto
+            cmd = 'L' if cmd=='M' else 'l'
+
+        upper = cmd.upper()
+        rel = current if cmd.islower() else 0j
+        if upper=='Z':
+            if current != start or len(kinds)==0 or subpath_end[-1]:
+                add(LINE, [current, start])
+            current = start
+            subpath_end[-1] = True
+            last_cmd = upper
+            continue
+
+        args = numbers(_PATH_NUMARGS[upper], flags=(3,4) if upper=='A' else ())
+        if upper=='M':
+            if len(kinds) > 0:
+                subpath_end[-1] = True
+            current = start = complex(args[0], args[1]) + rel
+        elif upper=='L':
+            end = complex(args[0], args[1]) + rel
+            add(LINE, [current, end])
+            current = end
+        elif upper=='H':
+            end = complex(args[0] + (current.real if cmd=='h' else 0), current.imag)
+            add(LINE, [current, end])
+            current = end
+        elif upper=='V':
+            end = complex(current.real, args[0] + (current.imag if cmd=='v' else 0))
+            add(LINE, [current, end])
+            current = end
+        elif upper in ('C', 'S'):
+            if upper=='C':
+                c1 = complex(args[0], args[1]) + rel
+                args = args[2:]
+            else: # reflection of the previous cubic control point
+                c1 = 2*current - last_ctrl if last_cmd in ('C', 'S') else current
+            c2 = complex(args[0], args[1]) + rel
+            end = complex(args[2], args[3]) + rel
+            add(CUBIC, [current, c1, c2, end])
+            current, last_ctrl = end, c2
+        elif upper in ('Q', 'T'):
+            if upper=='Q':
+                c1 = complex(args[0], args[1]) + rel
+                args = args[2:]
+            else:
+                c1 = 2*current - last_ctrl if last_cmd in ('Q', 'T') else current
+            end = complex(args[0], args[1]) + rel
+            add(QUAD, [current, c1, end])
+            current, last_ctrl = end, c1
+        elif upper=='A':
+            end = complex(args[5], args[6]) + rel
+            if args[0]==0 or args[1]==0:
+                add(LINE, [current, end])
+            elif end != current:
+                add(ARC, [current, end], tuple(args[:5]))
+            current = end
+        last_cmd = upper
+
+    if len(kinds) > 0:
+        subpath_end[-1] = True
+
+    return {
+        'kind': np.array(kinds, dtype=np.int8),
+        'ctrl': np.array(ctrls, dtype=complex).reshape(-1,4),
+        'arc': np.array(arcs, dtype=float).reshape(-1,5),
+        'subpath_end': np.array(subpath_end, dtype=bool),
+    }
+
+
+def _arc_centers(p0, p1, arc):
+    """ endpoint to center parameterization (svg spec F.6.5), vectorized: center, rx, ry, phi, theta1, dtheta """
+    rx, ry = np.abs(arc[:,0]), np.abs(arc[:,1])
+    phi = np.radians(arc[:,2])
+    large, sweep = arc[:,3]!=0, arc[:,4]!=0
+    rot = np.exp(-1j*phi)
+
+    d = (p0 - p1)/2 * rot
+    lam = (d.real/rx)**2 + (d.imag/ry)**2
+    scale = np.sqrt(np.maximum(lam, 1))
+    rx, ry = rx*scale, ry*scale
+
+    num = (rx*ry)**2 - (rx*d.imag)**2 - (ry*d.real)**2
+    den = (rx*d.imag)**2 + (ry*d.real)**2
+    coef = np.sqrt(np.maximum(num, 0)/den) * np.where(large==sweep, -1, 1)
+    cprime = coef*(rx*d.imag/ry - 1j*ry*d.real/rx)
+    center = cprime/rot + (p0 + p1)/2
+
+    u = (d - cprime)
+    v = (-d - cprime)
+    theta1 = np.angle(u.real/rx + 1j*u.imag/ry)
+    dtheta = np.angle(v.real/rx + 1j*v.imag/ry) - theta1
+    dtheta = np.where(~sweep & (dtheta > 0), dtheta - 2*np.pi, dtheta)
+    dtheta = np.where(sweep & (dtheta < 0), dtheta + 2*np.pi, dtheta)
+    return center, rx, ry, phi, theta1, dtheta
+
+
+def flatten_paths(paths_d:List[str], tolerance=0.1, max_samples=256):
+    """
+    polylines [(M_i,2)] through all segments of svg paths (subpaths concatenated), each curve sampled with
+    the fewest points keeping the chord error below tolerance (in path units), lines by their end points only;
+    the segments of all paths are evaluated together
+    """
+    parsed = [parse_path_arrays(path_d) for path_d in paths_d]
+    if len(parsed)==0:
+        return []
+    pathidx = np.repeat(np.arange(len(parsed)), [len(segs['kind']) for segs in parsed])
+    kind = np.concatenate([segs['kind'] for segs in parsed])
+    ctrl = np.concatenate([segs['ctrl'] for segs in parsed])
+    arcparams = np.concatenate([segs['arc'] for segs in parsed])
+    subpath_end = np.concatenate([segs['subpath_end'] for segs in parsed])
+    if len(kind)==0:
+        return [np.zeros((0,2)) for _ in parsed]
+
+    # samples per segment from the chord error bound max|p''|/(8n^2) of a curve p(t) sampled at n intervals
+    numsamples = np.ones(len(kind), dtype=np.int64)
+    cubic = kind==CUBIC
+    dd = np.maximum(np.abs(ctrl[cubic,0] - 2*ctrl[cubic,1] + ctrl[cubic,2]), np.abs(ctrl[cubic,1] - 2*ctrl[cubic,2] + ctrl[cubic,3]))
+    numsamples[cubic] = np.ceil(np.sqrt(6*dd/(8*tolerance)))
+    quad = kind==QUAD
+    dd = np.abs(ctrl[quad,0] - 2*ctrl[quad,1] + ctrl[quad,2])
+    numsamples[quad] = np.ceil(np.sqrt(2*dd/(8*tolerance)))
+
+    arc = kind==ARC
+    if arc.any():
+        center, rx, ry, phi, theta1, dtheta = _arc_centers(ctrl[arc,0], ctrl[arc,3], arcparams[arc])
+        # same bound in the angle parameter: |d2p/dtheta2| <= max(rx, ry)
+        numsamples[arc] = np.ceil(np.abs(dtheta)*np.sqrt(np.maximum(rx, ry)/(8*tolerance)))
+    numsamples = np.clip(numsamples, 1, max_samples)
+
+    # all samples at once: segment index and t in [0,1) of each, end points are the next segment's start
+    segidx = np.repeat(np.arange(len(kind)), numsamples)
+    offsets = np.cumsum(numsamples) - numsamples
+    t = (np.arange(len(segidx)) - offsets[segidx]) / numsamples[segidx]
+    pts = np.empty(len(segidx), dtype=complex)
+
+    sk = kind[segidx]
+    for k in (LINE, QUAD, CUBIC):
+        sel = sk==k
+        tt, cc = t[sel], ctrl[segidx[sel]]
+        if k==LINE:
+            pts[sel] = cc[:,0] + tt*(cc[:,3] - cc[:,0])
+        elif k==QUAD:
+            pts[sel] = (1-tt)**2*cc[:,0] + 2*(1-tt)*tt*cc[:,1] + tt**2*cc[:,2]
+        else:
+            pts[sel] = (1-tt)**3*cc[:,0] + 3*(1-tt)**2*tt*cc[:,1] + 3*(1-tt)*tt**2*cc[:,2] + tt**3*cc[:,3]
+
+    if arc.any():
+        sel = sk==ARC
+        ai = (np.cumsum(arc) - 1)[segidx[sel]] # row in the arc parameter arrays
+        theta = theta1[ai] + t[sel]*dtheta[ai]
+        pts[sel] = center[ai] + np.exp(1j*phi[ai])*(rx[ai]*np.cos(theta) + 1j*ry[ai]*np.sin(theta))
+
+    # end points where the next segment does not continue from them (end of subpaths and paths)
+    ends = np.flatnonzero(subpath_end | np.append(ctrl[1:,0] != ctrl[:-1,3], True))
+    pts = np.insert(pts, offsets[ends] + numsamples[ends], ctrl[ends,3])
+
+    counts = np.bincount(pathidx, weights=numsamples, minlength=len(parsed)) + \
+             np.bincount(pathidx[ends], minlength=len(parsed))
+    coords = np.stack([pts.real, pts.imag], axis=1)
+    return np.split(coords, np.cumsum(counts.astype(np.int64))[:-1])
+
+
+def flatten_path(path_d:str, tolerance=0.1, max_samples=256):
+    """ flatten_paths for a single path """
+    return flatten_paths([path_d], tolerance, max_samples)[0]
+
+
+def _path_to_coords(path_d, scale, tolerance=0.5):
+    # tolerance: max deviation from the curves, in output (scaled) units
+    return flatten_path(path_d, tolerance/scale)*scale
+
+def iter_svg_paths_as_shapes(chunks, scale=1, batch_size=256):
+    """
+    streaming svg parsing: chunks is an iterable of str/bytes (e.g. response.iter_content()),
+    yields (structure_id, shape) as the paths arrive, each path element is released once read;
+    paths are flattened batch_size at a time
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    batch = [] # (ontoid, d)
+    open_elts = [] # root ... parent of the current element
+
+    def convert(batch):
+        # tolerance of half an output pixel
+        rings = [coords*scale for coords in flatten_paths([pathd for _,pathd in batch], 0.5/scale)]
+        return zip([ontoid for ontoid,_ in batch], polygons_from_rings(rings, make_valid=True))
+
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+
+        for event, elt in parser.read_events():
+            if event == 'start':
+                open_elts.append(elt)
+                continue
+            open_elts.pop()
+            if elt.tag.rsplit('}',1)[-1] == 'path':
+                batch.append((int(elt.attrib['structure_id']), elt.attrib['d'])) # NOTE: from xml default type is str
+            if len(open_elts) > 0:
+                open_elts[-1].remove(elt) # detach from the tree, which stays at the open elements only
+
+        if len(batch) >= batch_size or (chunk is None and len(batch) > 0):
+            yield from convert(batch)
+            batch = []
 
-    path = parse_path(path_d)
-    coords = []
-    for ii,seg in enumerate(path):
-        # pt1 = [seg.start.real, seg.start.imag]
-        # pt2 = [seg.end.real, seg.end.imag]
-        # if ii == 0:
-        #     coords.append(pt1)
-        # coords.append(pt2)
-        
-        for t in np.linspace(0, 1, num=10):  # More points = smoother
-            pt = seg.point(t)
-            pt2 = (pt.real,pt.imag)
-            coords.append(pt2)
-    
-    return np.array(coords)*scale
 
 def get_svg_paths_as_shapes(svg_data, scale=1):
-    root = ET.fromstring(svg_data)
-
     shapes = defaultdict(list)
-
-    for elt in root.findall(".//{*}path"):
-        ontoid = int(elt.attrib['structure_id']) # NOTE: from xml default type is str
-        pathd = elt.attrib['d']
-        coords = _path_to_coords(pathd,scale)
-        # print(ontoid,len(coords))
-        shp = make_polyshape([coords],make_valid=True)
-        
+    for ontoid, shp in iter_svg_paths_as_shapes([svg_data], scale):
         shapes[ontoid].append(shp)
-
     return shapes
 
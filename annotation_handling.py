@@ -6,87 +6,397 @@ from typing import Dict, List
 
 Annotation = Dict[int,shapely.Geometry]
 
-def get_longest_side_line(shape:shapely.Geometry, side='right'):
-
-    mrr = shape.minimum_rotated_rectangle
-    if isinstance(mrr, shapely.Polygon):
-        mbr_points = list(zip(*mrr.exterior.coords.xy))
-        mbr_lines = [shapely.LineString((mbr_points[i], mbr_points[i + 1])) for i in range(len(mbr_points) - 1)]
-        mbr_line_lengths = [line.length for line in mbr_lines]
-        lineidx = np.argmax(mbr_line_lengths)
+def _longest_side_lines(mrrs:np.ndarray, side='right'):
+    """
+    longest side of minimum rotated rectangles, vectorized: (p1 (N,2), p2 (N,2), short side length (N,), valid (N,))
+    of the longest sides (or of the opposite side, if it is further on 'side'), valid is False for degenerate rectangles
+    """
+    p1 = np.full((len(mrrs),2), np.nan)
+    p2 = np.full((len(mrrs),2), np.nan)
+    short_length = np.zeros(len(mrrs))
+
+    valid = shapely.get_type_id(mrrs)==shapely.GeometryType.POLYGON
+    rings = shapely.get_exterior_ring(mrrs[valid])
+    valid[valid] = shapely.get_num_coordinates(rings)==5
+    if not valid.any():
+        return p1, p2, short_length, valid
+
+    pts = shapely.get_coordinates(shapely.get_exterior_ring(mrrs[valid])).reshape(-1,5,2)
+    lengths = np.hypot(*np.moveaxis(np.diff(pts, axis=1), 2, 0))
+    lineidx = np.argmax(lengths, axis=1)
+    rows = np.arange(len(pts))
+
+    vp1, vp2 = pts[rows,lineidx], pts[rows,lineidx+1]
+    p1a, p2a = pts[rows,(lineidx+2)%4], pts[rows,(lineidx+3)%4]
+    if side=='right':
+        opposite = np.maximum(p1a[:,0], p2a[:,0]) > np.maximum(vp1[:,0], vp2[:,0])
+    else:
+        opposite = np.minimum(p1a[:,0], p2a[:,0]) < np.minimum(vp1[:,0], vp2[:,0])
 
-        short_length = mbr_line_lengths[(lineidx + 1) % 4]
+    p1[valid] = np.where(opposite[:,None], p1a, vp1)
+    p2[valid] = np.where(opposite[:,None], p2a, vp2)
+    short_length[valid] = lengths[rows,(lineidx+1)%4]
+    return p1, p2, short_length, valid
 
-        p1, p2 = mbr_points[lineidx], mbr_points[lineidx + 1]
-        p1a, p2a = mbr_points[(lineidx + 2) % 4], mbr_points[(lineidx + 3) % 4]
 
-        if (side == 'right' and max(p1a[0], p2a[0]) > max(p1[0], p2[0])) or (side == 'left' and min(p1a[0], p2a[0]) < min(p1[0], p2[0])):
-            return p1a, p2a, short_length
+def get_longest_side_line(shape:shapely.Geometry, side='right'):
 
-        return p1, p2, short_length
+    p1, p2, short_length, valid = _longest_side_lines(np.array([shape.minimum_rotated_rectangle]), side)
+    if valid[0]:
+        return tuple(p1[0]), tuple(p2[0]), short_length[0]
     return None, None, 0    
 
 
 def _line_orientation(p1, p2):
-    return np.arctan2(p2[1] - p1[1], p2[0] - p1[0]) * 180 / np.pi
+    return np.arctan2(p2[...,1] - p1[...,1], p2[...,0] - p1[...,0]) * 180 / np.pi
+
+def _orientations(p1, p2, valid):
+    """ vectorized shape_orientation from _longest_side_lines """
+    flip = p1[:,0] > p2[:,0]
+    angles = np.where(flip, _line_orientation(p2, p1), _line_orientation(p1, p2))
+    return np.where(valid, angles, 0)
     
 def shape_orientation(shape:shapely.Geometry):
-    p1, p2, _ = get_longest_side_line(shape)
-    if p1 is not None:
-        if p1[0] > p2[0]:
-            return _line_orientation(p2, p1)
-        else:
-            return _line_orientation(p1, p2)
-    return 0
+    p1, p2, _, valid = _longest_side_lines(np.array([shape.minimum_rotated_rectangle]))
+    return _orientations(p1, p2, valid)[0]
+
+
+def _has_3_distinct_points(rings:List[np.ndarray]):
+    """ for each ring, whether it has at least 3 distinct points (vectorized over all rings) """
+    lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+    valid = np.zeros(len(rings), dtype=bool)
+    if lengths.sum() == 0:
+        return valid
+    coords = np.concatenate([np.asarray(ring, dtype=float).reshape(-1,2) for ring in rings])
+    ringidx = np.repeat(np.arange(len(rings)), lengths)
+    starts = np.cumsum(lengths) - lengths
+
+    # a second distinct point: the first one differing from the ring start, a third: differing from both
+    differs = (coords != coords[starts[ringidx]]).any(axis=1)
+    diffidx = np.flatnonzero(differs)
+    rings2, first2 = np.unique(ringidx[diffidx], return_index=True)
+    second = np.full(len(rings), -1, dtype=np.int64)
+    second[rings2] = diffidx[first2]
+    has2 = second[ringidx] >= 0
+    differs &= has2 
+    differs[has2] &= (coords[has2] != coords[second[ringidx[has2]]]).any(axis=1)
+    valid[np.unique(ringidx[differs])] = True
+    return valid
+
+
+def polygons_from_rings(rings:List[np.ndarray], make_valid=True, polyidx=None):
+    """ 
+    array of polygons from a list of (N_i,2) ring coordinates, built in one go;
+    polyidx: polygon index of each ring (the first ring of a polygon is its shell, the next ones its holes),
+    one polygon per ring by default; shells with fewer than 3 distinct points give empty polygons
+    (such holes are dropped), so that there is always one polygon per index;
+    make_valid repairs them with a single vectorized buffer(0)
+    """
+    if polyidx is None:
+        polyidx = np.arange(len(rings))
+    polyidx = np.asarray(polyidx, dtype=np.int64)
+    numpolys = polyidx.max()+1 if len(polyidx) > 0 else 0
+    polys = np.full(numpolys, shapely.Polygon(), dtype=object)
+
+    # rings of polygons with a degenerate shell, and degenerate holes, are left out
+    valid = _has_3_distinct_points(rings)
+    isshell = np.ones(len(rings), dtype=bool)
+    isshell[1:] = polyidx[1:] != polyidx[:-1]
+    shell_valid = np.zeros(numpolys, dtype=bool)
+    shell_valid[polyidx[isshell & valid]] = True
+    keep = np.flatnonzero(valid & shell_valid[polyidx])
+    if len(keep) == 0:
+        return polys
+
+    lengths = [len(rings[ii]) for ii in keep]
+    ringidx = np.repeat(np.arange(len(keep)), lengths)
+    linearrings = shapely.linearrings(np.concatenate([rings[ii] for ii in keep]), indices=ringidx)
+    shapely.polygons(linearrings, indices=polyidx[keep], out=polys)
+    if make_valid:
+        polys = shapely.buffer(polys, 0)
+    return polys
+
+
+def union_by_id(ids, geoms) -> 'Annotation':
+    """ 
+    id:union of the geoms with that id, ids in order of first appearance
+    each group is merged with one shapely.union_all instead of pairwise unions
+    """
+    if len(ids) == 0:
+        return {}
+    geoms = np.asarray(geoms, dtype=object)
+    uniq, first, inverse = np.unique(np.asarray(ids), return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(uniq)))
+    groups = np.split(geoms[order], bounds[:-1])
+
+    outdict = {}
+    for gi in np.argsort(first):
+        grp = groups[gi]
+        outdict[uniq[gi].item()] = grp[0] if len(grp) == 1 else shapely.union_all(grp)
+    return outdict
+
+
+def save_annotation(fp, annot:'Annotation'):
+    """ writes an annotation as columns: ontoids and concatenated WKB with offsets (.npz) """
+    ontoids = np.array(list(annot.keys()), dtype=np.int64)
+    wkbs = shapely.to_wkb(np.array(list(annot.values()), dtype=object))
+    offsets = np.cumsum([0]+[len(w) for w in wkbs], dtype=np.int64)
+    blob = np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+    np.savez(fp, ontoids=ontoids, offsets=offsets, wkb=blob)
+
+
+def load_annotation(fp):
+    """ reverse of save_annotation """
+    with np.load(fp, allow_pickle=False) as npz:
+        ontoids = npz['ontoids']
+        offsets = npz['offsets']
+        blob = npz['wkb'].tobytes()
+    wkbs = [blob[offsets[ii]:offsets[ii+1]] for ii in range(len(ontoids))]
+    geoms = shapely.from_wkb(wkbs)
+    return dict(zip(ontoids.tolist(), geoms))
+
+
+def _de9im_predicates(im:str, dim_a:int, dim_b:int):
+    """ touches, crosses, overlaps of a with b, from their DE-9IM matrix (a intersects b) """
+    def t(ii):
+        return im[ii] != 'F'
+
+    touches = im[0] == 'F' and (t(1) or t(3) or t(4))
+
+    if dim_a < dim_b:
+        crosses = t(0) and t(2)
+    elif dim_a > dim_b:
+        crosses = t(0) and t(6)
+    else:
+        crosses = dim_a == 1 and im[0] == '0'
+
+    if dim_a != dim_b:
+        overlaps = False
+    elif dim_a == 1:
+        overlaps = im[0] == '1' and t(2) and t(6)
+    else:
+        overlaps = t(0) and t(2) and t(6)
+
+    return touches, crosses, overlaps
+
+
+class AnnotationIndex:
+    """
+    STRtree over the shapes of an annotation, for neighbourhood queries without all-pairs loops
+    """
+    def __init__(self, annot:'Annotation'):
+        self.ontoids = list(annot.keys())
+        self.geoms = np.array(list(annot.values()), dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+
+    def __len__(self):
+        return len(self.ontoids)
+
+    def query(self, geom:shapely.Geometry, predicate='intersects'):
+        """ ontoids of the shapes for which predicate(geom, shape) holds """
+        return [self.ontoids[ii] for ii in sorted(self.tree.query(geom, predicate=predicate))]
+
+    def intersecting_pairs(self):
+        """ index arrays (ii, jj), ii<jj, of all pairs of intersecting shapes """
+        ii, jj = self.tree.query(self.geoms, predicate='intersects')
+        keep = ii < jj
+        return ii[keep], jj[keep]
+
+    def get_adjacency(self):
+        """ same as get_adjacency(annot) """
+        ii, jj = self.intersecting_pairs()
+
+        # one DE-9IM matrix per unordered pair, transposed for the reverse direction
+        matrices = shapely.relate(self.geoms[ii], self.geoms[jj])
+        dims = shapely.get_dimensions(self.geoms)
+
+        relations = [] # (ii, jj, touches, crosses, overlaps) for both directions
+        for pi, pj, im in zip(ii, jj, matrices):
+            im_t = ''.join([im[3*c+r] for r in range(3) for c in range(3)])
+            relations.append((pi, pj) + _de9im_predicates(im, dims[pi], dims[pj]))
+            relations.append((pj, pi) + _de9im_predicates(im_t, dims[pj], dims[pi]))
+        relations.sort()
+
+        edges = {'touches':[], 'crosses':[], 'intersects':[], 'overlaps':[]}
+        for pi, pj, touches, crosses, overlaps in relations:
+            pair = (self.ontoids[pi], self.ontoids[pj])
+            if touches:
+                edges['touches'].append(pair)
+            if crosses:
+                edges['crosses'].append(pair)
+            edges['intersects'].append(pair)
+            if overlaps:
+                edges['overlaps'].append(pair)
+
+        return edges
 
 
 def get_adjacency(annot:'Annotation'):
-    edges = {'touches':[], 'crosses':[], 'intersects':[], 'overlaps':[]}
-    for onto_i in annot:
-        for onto_j in annot:
-            if onto_i==onto_j:
-                continue
-            if annot[onto_i].touches(annot[onto_j]):
-                edges['touches'].append((onto_i,onto_j))
-            if annot[onto_i].crosses(annot[onto_j]):
-                edges['crosses'].append((onto_i,onto_j))
-            if annot[onto_i].intersects(annot[onto_j]):
-                edges['intersects'].append((onto_i,onto_j))
-            if annot[onto_i].overlaps(annot[onto_j]):
-                edges['overlaps'].append((onto_i,onto_j))    
-                
-    return edges
+    return AnnotationIndex(annot).get_adjacency()
+
+
+def _smallest_widths(geoms:np.ndarray):
+    """
+    width of the thinnest component of each shape (diameter of its maximum inscribed circle), 
+    i.e. the pixel size at which the structure starts to dissolve
+    """
+    parts, index = shapely.get_parts(geoms, return_index=True)
+    keep = ~shapely.is_empty(parts) & (shapely.get_type_id(parts)==shapely.GeometryType.POLYGON)
+    parts, index = parts[keep], index[keep]
+    if hasattr(shapely, 'maximum_inscribed_circle'): # shapely>=2.1
+        bounds = shapely.bounds(parts)
+        tolerance = np.maximum(bounds[:,2]-bounds[:,0], bounds[:,3]-bounds[:,1])/100 # plenty for a zoom level
+        widths = 2*shapely.length(shapely.maximum_inscribed_circle(parts, tolerance))
+    else: # width of a strip of the same area and perimeter
+        widths = 4*shapely.area(parts)/np.maximum(shapely.length(parts), 1e-12)
+
+    smallest = np.full(len(geoms), np.inf)
+    np.minimum.at(smallest, index, widths)
+    smallest[np.isinf(smallest)] = 0
+    return smallest
+
+
+def get_properties_table(annot:'Annotation'):
+    """
+    properties of all shapes of an annotation as columns (arrays in sorted ontoid order):
+    ontoid, pt (representative point), pt_x, pt_y (nan if empty), area, perimeter, numcomp, obb (minimum rotated rectangle),
+    majoraxis ((N,2,2) end points of the longest obb side, nan if degenerate), minoraxis (shortest obb side length),
+    orientation (degrees), smallestwidth
+    """
+    ontoids = np.array(sorted(annot), dtype=np.int64)
+    geoms = np.array([annot[oid] for oid in ontoids.tolist()], dtype=object)
+
+    pts = shapely.point_on_surface(geoms)
+    mrrs = shapely.minimum_rotated_rectangle(geoms)
+    p1, p2, short_length, valid = _longest_side_lines(mrrs)
+    ptcoords = np.full((len(pts),2), np.nan) # stays nan for empty shapes
+    nonempty = ~shapely.is_empty(pts)
+    ptcoords[nonempty] = shapely.get_coordinates(pts[nonempty]).reshape(-1,2)
+
+    return {
+        'ontoid': ontoids,
+        'pt': pts,
+        'pt_x': ptcoords[:,0],
+        'pt_y': ptcoords[:,1],
+        'area': shapely.area(geoms),
+        'perimeter': shapely.length(geoms),
+        'numcomp': shapely.get_num_geometries(geoms),
+        'obb': mrrs,
+        'majoraxis': np.stack([p1, p2], axis=1),
+        'minoraxis': short_length,
+        'orientation': _orientations(p1, p2, valid),
+        'smallestwidth': _smallest_widths(geoms),
+    }
+
+
+def get_properties_tables(annots:Dict[int,'Annotation']):
+    """ get_properties_table for many sections (secnum: annotation), concatenated with a secnum column """
+    tables = [(secnum, get_properties_table(annot)) for secnum, annot in annots.items()]
+    if len(tables)==0:
+        return {**get_properties_table({}), 'secnum':np.zeros(0, dtype=np.int64)}
+
+    out = {'secnum': np.concatenate([np.full(len(tbl['ontoid']), secnum, dtype=np.int64) for secnum,tbl in tables])}
+    for key in tables[0][1]:
+        out[key] = np.concatenate([tbl[key] for _,tbl in tables])
+    return out
 
 
 def get_properties(shape:shapely.Geometry):
+    tbl = get_properties_table({0:shape})
+    p1, p2 = tbl['majoraxis'][0]
     return {
-        'pt': shape.representative_point(),
-        'area': shape.area,
-        'perimeter': shape.length,
-        'numcomp': len(shape.geoms),
-        'obb': shape.minimum_rotated_rectangle,
-        'majoraxis': get_longest_side_line(shape)[:2],
-        'smallestwidth': 0, # FIXME: this should help to find at what zoom the structure will start to dissolve
+        'pt': tbl['pt'][0],
+        'area': tbl['area'][0],
+        'perimeter': tbl['perimeter'][0],
+        'numcomp': tbl['numcomp'][0],
+        'obb': tbl['obb'][0],
+        'majoraxis': (tuple(p1), tuple(p2)) if not np.isnan(p1).any() else (None, None),
+        'smallestwidth': tbl['smallestwidth'][0],
     }
 
 
+def _max_extent(bounds:np.ndarray):
+    return np.maximum(bounds[...,2]-bounds[...,0], bounds[...,3]-bounds[...,1])
+
+
+class NearestShapeIndex:
+    """
+    STRtree over candidate shapes for nearest_shape queries (smallest hausdorff distance, with the same 
+    rejection rules): candidates further than the query width are pruned by the tree, the others are
+    evaluated by increasing lower bound (bounding box offsets, which the discrete hausdorff distance 
+    cannot be below) until the bound exceeds the best distance found
+    """
+    BATCH = 8
+
+    def __init__(self, candidates:List[shapely.Geometry]):
+        self.candidates = np.array(candidates, dtype=object).reshape(-1)
+        self.bounds = shapely.bounds(self.candidates).reshape(-1,4)
+        self.widths = _max_extent(self.bounds)
+        self.tree = shapely.STRtree(self.candidates)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def _best(self, shp:shapely.Geometry, cand_idxs:np.ndarray):
+        """ (index, distance) of the smallest hausdorff distance among cand_idxs, first index on ties """
+        lowerbounds = np.abs(self.bounds[cand_idxs] - np.array(shp.bounds)).max(axis=1)
+        order = np.lexsort((cand_idxs, lowerbounds))
+        cand_idxs, lowerbounds = cand_idxs[order], lowerbounds[order]
+
+        best, bestdist = -1, np.inf
+        for start in range(0, len(cand_idxs), self.BATCH):
+            if lowerbounds[start] > bestdist:
+                break
+            batch = cand_idxs[start:start+self.BATCH]
+            dists = shapely.hausdorff_distance(shp, self.candidates[batch])
+            for idx, dist in zip(batch, dists):
+                if dist < bestdist or (dist==bestdist and idx < best):
+                    best, bestdist = idx, dist
+        return best, bestdist
+
+    def nearest(self, shp:shapely.Geometry):
+        """ (index of the nearest candidate, hausdorff distance), (-1, inf) if none or rejected """
+        idxs, dists = self.nearest_many([shp])
+        return idxs[0], dists[0]
+
+    def nearest_many(self, queries:List[shapely.Geometry]):
+        """ bulk nearest: (indices (-1 if none), distances (inf if none)) for each query """
+        queries = np.array(queries, dtype=object).reshape(-1)
+        out_idxs = np.full(len(queries), -1, dtype=np.int64)
+        out_dists = np.full(len(queries), np.inf)
+        if len(queries)==0 or len(self.candidates)==0:
+            return out_idxs, out_dists
+
+        # the best distance has to be within the query width, (min) distance is a lower bound of hausdorff
+        qwidths = _max_extent(shapely.bounds(queries))
+        qidxs, cidxs = self.tree.query(queries, predicate='dwithin', distance=qwidths)
+        splits = np.flatnonzero(np.diff(qidxs))+1
+        for qcands, cands in zip(np.split(qidxs, splits), np.split(cidxs, splits)):
+            if len(qcands)==0:
+                continue
+            qi = qcands[0]
+            best, dist = self._best(queries[qi], cands)
+            if dist <= qwidths[qi] and dist <= self.widths[best]:
+                out_idxs[qi], out_dists[qi] = best, dist
+        return out_idxs, out_dists
+
+
+def nearest_shapes(queries:List[shapely.Geometry], candidates:List[shapely.Geometry]):
+    """ nearest_shape for many queries against the same candidates: (indices into candidates (-1 if none), distances) """
+    return NearestShapeIndex(candidates).nearest_many(queries)
+
+
 def nearest_shape(shp:shapely.Geometry,otherlist:List[shapely.Geometry]):
-    distances = [shapely.hausdorff_distance(shp,other) for other in otherlist]
-    if len(distances)==0:
+    if len(otherlist)==0:
         return None, np.inf
-    minidx = np.argmin(distances)
-    dv = distances[minidx]
-    nr = otherlist[minidx]
-    minx,miny,maxx,maxy=nr.bounds
-    width = max((maxx-minx),(maxy-miny))
-    if dv > width:
+    idx, dv = NearestShapeIndex(otherlist).nearest(shp)
+    if idx < 0:
         return None, np.inf
-
-    minx,miny,maxx,maxy=shp.bounds
-    width = max((maxx-minx),(maxy-miny))
-    if dv > width:
-        return None, np.inf
-    return nr, dv
+    return otherlist[idx], dv
 
 
 def get_level_ids(annot:'Annotation', ontohelper:'TreeHelper'):
@@ -143,6 +453,7 @@ def get_nonreachable(annot:'Annotation', ontohelper:'TreeHelper'):
     for ontoid,rec in ontohelper.onto_lookup.items():
         if ontoid not in reachable and ontoid not in annot:
             nonreachable.append(ontoid)
+    nonreachable_set = set(nonreachable)
 
     # organize as parent:[children]
     nrdict = defaultdict(list)
@@ -150,7 +461,7 @@ def get_nonreachable(annot:'Annotation', ontohelper:'TreeHelper'):
     for oid in nonreachable:
         parentid = ontohelper.onto_lookup[oid].parentid
         
-        if parentid in nonreachable:
+        if parentid in nonreachable_set:
             nrdict[parentid].append(oid)
         else:
             leaves.append(oid)
@@ -190,8 +501,7 @@ def get_supershape(ontoid:int, annot:'Annotation', ontohelper:'TreeHelper'):
     parshp = None
     chlist = []
     for annot_id in annot:
-        anclist = ontohelper.get_ancestor_ids(annot_id)
-        if ontoid in anclist:
+        if ontohelper.is_ancestor(ontoid, annot_id):
             chlist.append(annot_id)
             if parshp is None:
                 parshp = annot[annot_id]
@@ -200,17 +510,205 @@ def get_supershape(ontoid:int, annot:'Annotation', ontohelper:'TreeHelper'):
     
     return parshp, chlist
 
+class SuperShapes:
+    """
+    supershapes of all ontology ancestors of the annotated ids, built bottom-up in one pass:
+    each node is unioned once from its own shape and its children's already merged shapes
+    """
+    def __init__(self, annot:'Annotation', ontohelper:'TreeHelper'):
+        self.annot = annot
+        self.ontohelper = ontohelper
+        lookup = ontohelper.onto_lookup
+
+        self.members = defaultdict(list) # id: annotated descendant ids (chlist of get_supershape)
+        parts = defaultdict(list)
+        for annot_id, shp in annot.items():
+            parts[annot_id].append(shp)
+            if annot_id in lookup:
+                for ancid in ontohelper.get_ancestor_ids(annot_id):
+                    self.members[ancid].append(annot_id)
+
+        # deepest first, so that all children are merged before their parent
+        self.merged:Dict[int,shapely.Geometry] = {} # id: union of its own and all descendant shapes
+        nodes = set(parts) | set(self.members)
+        for ontoid in sorted(nodes, key=lambda oid: -lookup[oid].level if oid in lookup else 0):
+            geoms = parts.pop(ontoid)
+            if len(geoms)==1:
+                merged = geoms[0]
+            else:
+                merged = _remove_small_interiors(shapely.unary_union(geoms)).buffer(0)
+            self.merged[ontoid] = merged
+
+            if ontoid in lookup and lookup[ontoid].parentid in nodes:
+                parts[lookup[ontoid].parentid].append(merged)
+
+    def __contains__(self, ontoid:int):
+        return ontoid in self.merged
+
+    def __getitem__(self, ontoid:int):
+        """ drawn shape for annotated ids, merged descendant shapes otherwise """
+        if ontoid in self.annot:
+            return self.annot[ontoid]
+        return self.merged[ontoid]
+
+    def get_supershape(self, ontoid:int):
+        """ same as get_supershape(ontoid, annot, ontohelper) """
+        if ontoid in self.annot:
+            return self.annot[ontoid]
+        return self.merged.get(ontoid), list(self.members.get(ontoid, []))
+
+    def at_level(self, level:int) -> 'Annotation':
+        """ annotation with the (super)shapes of all ids at an ontology level """
+        lookup = self.ontohelper.onto_lookup
+        return {oid:self[oid] for oid in sorted(self.merged) if oid in lookup and lookup[oid].level==level}
+
+
+_supershapes_cache = [] # [(annot, ontohelper, SuperShapes)], most recent last
+SUPERSHAPES_CACHE_SIZE = 8
+
+def get_supershapes(annot:'Annotation', ontohelper:'TreeHelper'):
+    """ SuperShapes of a section annotation, cached for the last few annotations (by identity, do not mutate them) """
+    for ii, (cached_annot, cached_helper, supershapes) in enumerate(_supershapes_cache):
+        if cached_annot is annot and cached_helper is ontohelper:
+            _supershapes_cache.append(_supershapes_cache.pop(ii))
+            return supershapes
+
+    supershapes = SuperShapes(annot, ontohelper)
+    _supershapes_cache.append((annot, ontohelper, supershapes))
+    del _supershapes_cache[:-SUPERSHAPES_CACHE_SIZE]
+    return supershapes
+
 def find_superids(annot:'Annotation',ontohelper:'TreeHelper'):
 
     superids = defaultdict(list)
 
     for ontoid in annot:
-        parentids = ontohelper.get_ancestor_ids(ontoid)
-        
-        for drawnid in annot:
-            if drawnid in parentids:
+        for drawnid in ontohelper.get_ancestor_ids(ontoid):
+            if drawnid in annot:
                 superids[drawnid].append(ontoid)
 
     return superids
     
-    
\ No newline at end of file
+    
+#%% rasterization
+
+def _annotation_edges(geoms:np.ndarray):
+    """ non-horizontal edges of all rings (exteriors and holes) of all parts: x0, y0, x1, y1, geometry index """
+    parts, partgeomidx = shapely.get_parts(geoms, return_index=True)
+    rings, partidx = shapely.get_rings(parts, return_index=True)
+    geomidx = partgeomidx[partidx]
+    coords, ringidx = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ringidx[1:]==ringidx[:-1]
+    x0, y0 = coords[:-1][same_ring].T
+    x1, y1 = coords[1:][same_ring].T
+    gidx = geomidx[ringidx[:-1][same_ring]]
+    keep = y0!=y1
+    return x0[keep], y0[keep], x1[keep], y1[keep], gidx[keep]
+
+
+def _scanline_spans(edges, top:int, bottom:int):
+    """
+    even-odd fill of rows top..bottom-1 over all edges at once: (geometry index, row, first col, end col) spans;
+    pixel (r, c) is inside when its center (x=c, y=r) is, as in plt.imshow
+    """
+    x0, y0, x1, y1, gidx = edges
+    ylo, yhi = np.minimum(y0, y1), np.maximum(y0, y1)
+    # rows r with ylo <= r < yhi (half open, so that vertices are counted once)
+    rfirst = np.maximum(np.ceil(ylo).astype(np.int64), top)
+    rend = np.minimum(np.ceil(yhi).astype(np.int64), bottom)
+    numrows = np.maximum(rend - rfirst, 0)
+
+    eidx = np.repeat(np.arange(len(x0)), numrows)
+    rows = np.arange(len(eidx)) - np.repeat(np.cumsum(numrows) - numrows, numrows) + rfirst[eidx]
+    xs = x0[eidx] + (rows - y0[eidx]) * (x1[eidx] - x0[eidx]) / (y1[eidx] - y0[eidx])
+
+    # crossings sorted per (geometry, row), consecutive pairs are inside
+    order = np.lexsort((xs, rows, gidx[eidx]))
+    gg, rows, xs = gidx[eidx][order], rows[order], xs[order]
+    return gg[0::2], rows[0::2], np.ceil(xs[0::2]).astype(np.int64), np.ceil(xs[1::2]).astype(np.int64)
+
+
+def iter_label_tiles(annot:'Annotation', imshape, tile_size=2048, dtype=np.uint32, ontohelper:'TreeHelper'=None):
+    """
+    rasterizes an annotation tile by tile: yields (top, left, labels) with labels a (<=tile_size, <=tile_size)
+    array of ontoids (0 = background); coordinates are pixels of an imshape (height, width, ...) image.
+    overlapping shapes: deeper ontology levels are drawn over their parents when ontohelper is given,
+    later shapes over earlier ones otherwise
+    """
+    height, width = imshape[:2]
+    ontoids = [oid for oid,shp in annot.items() if not shp.is_empty]
+    if ontohelper is not None:
+        lookup = ontohelper.onto_lookup
+        ontoids.sort(key=lambda oid: lookup[oid].level if oid in lookup else 0)
+    geoms = np.array([annot[oid] for oid in ontoids], dtype=object)
+    labels = np.array(ontoids, dtype=dtype)
+
+    edges = _annotation_edges(geoms)
+    ylo, yhi = np.minimum(edges[1], edges[3]), np.maximum(edges[1], edges[3])
+    bounds = shapely.bounds(geoms).reshape(-1,4)
+
+    for top in range(0, height, tile_size):
+        bottom = min(top+tile_size, height)
+        rowsel = (yhi > top) & (ylo < bottom) # edges crossing rows of the tile
+        gg, rows, cfirst, cend = _scanline_spans(tuple(e[rowsel] for e in edges), top, bottom)
+
+        for left in range(0, width, tile_size):
+            right = min(left+tile_size, width)
+            tile = np.zeros((bottom-top, right-left), dtype=dtype)
+
+            sel = (cend > left) & (cfirst < right)
+            tg, tr = gg[sel], rows[sel]-top
+            tc0, tc1 = np.clip(cfirst[sel], left, right)-left, np.clip(cend[sel], left, right)-left
+            if len(tg)==0:
+                yield top, left, tile
+                continue
+
+            # one difference array per shape over its bounding box, in drawing order
+            splits = np.flatnonzero(np.diff(tg))+1
+            for gi, r, c0, c1 in zip(tg[np.r_[0, splits]], np.split(tr, splits), np.split(tc0, splits), np.split(tc1, splits)):
+                r0, r1 = r.min(), r.max()+1
+                b0 = max(int(np.floor(bounds[gi,0]))-left, 0)
+                b1 = min(int(np.ceil(bounds[gi,2]))+1-left, right-left)
+                w = b1-b0
+                if w <= 0:
+                    continue
+                flat = (r-r0)*(w+1)
+                diff = np.bincount(flat + c0-b0, minlength=(r1-r0)*(w+1)) - \
+                       np.bincount(flat + c1-b0, minlength=(r1-r0)*(w+1))
+                mask = np.cumsum(diff.reshape(r1-r0, w+1)[:,:w], axis=1) > 0
+                tile[r0:r1, b0:b1][mask] = labels[gi]
+
+            yield top, left, tile
+
+
+def rasterize_annotation(annot:'Annotation', imshape, dtype=None, ontohelper:'TreeHelper'=None, tile_size=2048, out=None):
+    """
+    ontoid label map (height, width) of an annotation, aligned with an image of shape imshape
+    (e.g. DharaniHelper.get_sectionimage with the annotation from get_annotation);
+    dtype: uint16 if all ontoids fit, uint32 otherwise; out: optional preallocated array (e.g. np.memmap)
+    """
+    if dtype is None:
+        dtype = np.uint16 if max(annot, default=0) <= np.iinfo(np.uint16).max else np.uint32
+    if out is None:
+        out = np.zeros(imshape[:2], dtype=dtype)
+    for top, left, tile in iter_label_tiles(annot, imshape, tile_size, dtype, ontohelper):
+        out[top:top+tile.shape[0], left:left+tile.shape[1]] = tile
+    return out
+
+
+def get_level_labels(labels:np.ndarray, ontohelper:'TreeHelper', levels:List[int]):
+    """
+    {level: label map of the ancestors at that level} from an ontoid label map,
+    pixels of structures above a level are 0 in its map
+    """
+    uniq, inverse = np.unique(labels, return_inverse=True)
+    out = {}
+    for level in levels:
+        lut = np.zeros(len(uniq), dtype=labels.dtype)
+        for ii, ontoid in enumerate(uniq.tolist()):
+            if ontoid in ontohelper.onto_lookup:
+                lineage = ontohelper.get_ancestor_ids(ontoid) + [ontoid]
+                if len(lineage) > level:
+                    lut[ii] = lineage[level]
+        out[level] = lut[inverse].reshape(labels.shape)
+    return out
@@ -0,0 +1,42 @@
+# compares block_mean_downsample against the per-channel scipy.ndimage.zoom path 
+# previously used in DharaniHelper.get_sectionimage
+#
+# usage: python benchmarks/bench_downsample.py
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import numpy as np
+from scipy.ndimage import zoom
+
+from image_ops import block_mean_downsample
+
+
+def zoom_downsample(page, factor):
+    shp = page.shape
+    out = np.zeros((shp[0]//factor, shp[1]//factor, shp[2]),page.dtype)
+    for ch in range(3):
+        out[...,ch] = zoom(page[...,ch],1/factor)
+    return out
+
+
+def timeit(fn, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter()-t0)
+    return best
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    page = rng.integers(0, 256, size=(4096, 6144, 3), dtype=np.uint8)
+
+    print('factor  zoom[s]  block_mean[s]  speedup')
+    for factor in (2, 4, 8, 16):
+        t_zoom = timeit(zoom_downsample, page, factor)
+        t_block = timeit(block_mean_downsample, page, factor)
+        print(f'{factor:6d}  {t_zoom:7.3f}  {t_block:13.3f}  {t_zoom/t_block:6.1f}x')
@@ -0,0 +1,62 @@
+# compares the batched, adaptive svg path flattener (allen_functions.get_svg_paths_as_shapes)
+# against svg.path sampling at 10 points per segment, previously used for Allen annotations;
+# also checks that open, degenerate and empty paths give (empty) shapes instead of failing
+#
+# usage: python benchmarks/bench_svg_paths.py
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import shapely
+from svg.path import parse_path
+
+from allen_functions import get_svg_paths_as_shapes, iter_svg_paths_as_shapes, make_polyshape
+
+
+def svg_path_coords(path_d, scale):
+    coords = [(pt.real, pt.imag) for seg in parse_path(path_d) for pt in [seg.point(t) for t in np.linspace(0, 1, num=10)]]
+    return np.array(coords)*scale
+
+
+def make_svg(numpaths, rng):
+    paths = []
+    for _ in range(numpaths):
+        x, y = rng.uniform(0, 900, size=2)
+        paths.append('<path structure_id="%d" d="M %.1f %.1f l 40 0 c 10 10 20 30 -10 40 a 20 10 0 0 1 -20 -20 z"/>'
+                     % (rng.integers(1, 20), x, y))
+    return '<svg xmlns="http://www.w3.org/2000/svg">' + ''.join(paths) + '</svg>'
+
+
+def check_degenerate_paths():
+    paths = ['M0 0 L10 10', 'M5 5 L5 5 Z', 'M1e1 1E1L2e1-5z', 'M5 5', 'M0 0 L10 0 L10 10 Z', 'M5 5']
+    svg = '<svg>' + ''.join('<path structure_id="%d" d="%s"/>' % (ii+1, d) for ii, d in enumerate(paths)) + '</svg>'
+    pairs = list(iter_svg_paths_as_shapes([svg], batch_size=4))
+    assert [ontoid for ontoid,_ in pairs] == list(range(1, len(paths)+1))
+    assert [shp.is_empty for _,shp in pairs] == [True, True, True, True, False, True]
+    assert pairs[4][1].area == 50
+
+
+if __name__ == '__main__':
+    check_degenerate_paths()
+
+    rng = np.random.default_rng(0)
+    svg = make_svg(2000, rng)
+    scale = 3/8
+
+    t0 = time.perf_counter()
+    paths = [elt.attrib['d'] for elt in ET.fromstring(svg).findall('.//{*}path')]
+    old = [make_polyshape([svg_path_coords(d, scale)], make_valid=True) for d in paths]
+    t_old = time.perf_counter()-t0
+
+    t0 = time.perf_counter()
+    new = get_svg_paths_as_shapes(svg, scale)
+    t_new = time.perf_counter()-t0
+
+    nv_old = sum(len(shapely.get_coordinates(shp)) for shp in old)
+    nv_new = sum(len(shapely.get_coordinates(shp)) for shps in new.values() for shp in shps)
+    print('paths  svg.path[s]  flattened[s]  speedup  vertices old/new')
+    print(f'{len(paths):5d}  {t_old:11.3f}  {t_new:12.3f}  {t_old/t_new:6.1f}x  {nv_old}/{nv_new}')
@@ -0,0 +1,117 @@
+# compares TreeHelper navigation lookups against the previous tree-walking implementations,
+# on a synthetic ~500 node ontology, called once per structure as in the annotation loops
+#
+# usage: python benchmarks/bench_treehelper.py
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import numpy as np
+
+from ontology_handling import TreeHelper
+
+
+def make_treenom(numnodes=500, seed=0):
+    rng = np.random.default_rng(seed)
+    counter = [0]
+
+    def make_node(level):
+        counter[0] += 1
+        nodeid = counter[0]
+        node = {'id':nodeid, 'acronym':f'S{nodeid}', 'name':f'structure {nodeid}', 'color_hex_triplet':'808080'}
+        if level < 6 and counter[0] < numnodes:
+            numchildren = int(rng.integers(1, 5))
+            node['children'] = [make_node(level+1) for _ in range(numchildren) if counter[0] < numnodes]
+        return node
+
+    roots = []
+    while counter[0] < numnodes:
+        roots.append(make_node(0))
+    return roots
+
+
+# previous implementations, walking treenom / scanning onto_lookup on every call
+
+def legacy_get_ancestor_ids(th, ontoid):
+    idlist = []
+    if ontoid>0:
+        lastrec = th.onto_lookup[ontoid]
+        while lastrec.parentid != 0:
+            idlist.append(lastrec.parentid)
+            lastrec = th.onto_lookup[lastrec.parentid]
+    return list(reversed(idlist))
+
+def legacy_get_node_by_ontoid(th, ontoid):
+    ancestorids = legacy_get_ancestor_ids(th, ontoid)
+    ancnode = None
+    for elt in th.treenom:
+        if elt['id'] in ancestorids:
+            ancnode = elt
+            break
+    node = None
+    while node is None:
+        if 'children' in ancnode:
+            for ch in ancnode['children']:
+                if ch['id'] in ancestorids:
+                    ancnode = ch 
+                elif ch['id']==ontoid:
+                    node = ch
+                    break
+        else:
+            break
+    return node
+
+def legacy_get_children_ids(th, ontoid):
+    nd = legacy_get_node_by_ontoid(th, ontoid)
+    if 'children' in nd:
+        return [int(ch['id']) for ch in nd['children']]
+    return []
+
+def legacy_get_sibling_ids(th, ontoid):
+    parentid = th.onto_lookup[ontoid].parentid
+    parentnode = legacy_get_node_by_ontoid(th, parentid)
+    return [int(elt['id']) for elt in parentnode['children']]
+
+def legacy_get_id_by_acronym(th, acro):
+    for id, rec in th.onto_lookup.items():
+        if acro == rec.acronym:
+            return id
+    return None
+
+def legacy_get_ids_by_level(th, level):
+    return [id for id,rec in th.onto_lookup.items() if rec.level==level]
+
+
+def timeit(fn, args):
+    t0 = time.perf_counter()
+    for arg in args:
+        fn(*arg)
+    return time.perf_counter()-t0
+
+
+if __name__ == '__main__':
+    th = TreeHelper(treenom=make_treenom())
+    rootids = {int(elt['id']) for elt in th.treenom}
+    ids = [ontoid for ontoid in th.onto_lookup if ontoid not in rootids]
+    rec_parent = {ontoid:th.onto_lookup[ontoid].parentid for ontoid in ids}
+    deeper = [ontoid for ontoid in ids if rec_parent[ontoid] not in rootids]
+    print(f'{len(th)} nodes, {len(ids)} calls per method')
+
+    cases = [
+        ('get_ancestor_ids', legacy_get_ancestor_ids, th.get_ancestor_ids, [(oid,) for oid in ids]),
+        ('_get_node_by_ontoid', legacy_get_node_by_ontoid, th._get_node_by_ontoid, [(oid,) for oid in deeper]),
+        ('get_children_ids', legacy_get_children_ids, th.get_children_ids, [(oid,) for oid in deeper]),
+        ('get_sibling_ids', legacy_get_sibling_ids, th.get_sibling_ids, [(oid,) for oid in deeper]),
+        ('_get_id_by_acronym', legacy_get_id_by_acronym, th._get_id_by_acronym, [(th.onto_lookup[oid].acronym,) for oid in ids]),
+        ('get_ids_by_level', legacy_get_ids_by_level, th.get_ids_by_level, [(th.onto_lookup[oid].level,) for oid in ids]),
+    ]
+
+    print('method                 legacy[ms]  indexed[ms]  speedup')
+    for name, legacy, indexed, args in cases:
+        for arg in args[:20]:
+            assert legacy(th, *arg) == indexed(*arg), name
+        t_legacy = timeit(lambda *a: legacy(th, *a), args)
+        t_indexed = timeit(indexed, args)
+        print(f'{name:21s}  {1000*t_legacy:10.2f}  {1000*t_indexed:11.2f}  {t_legacy/t_indexed:6.0f}x')
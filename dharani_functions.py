@@ -2,11 +2,13 @@ import s3fs
 import json
 import numpy as np
 import os
-from scipy.ndimage import zoom
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from image_access import PyrTifAccessor
-
-from collections import defaultdict
-from shapely.geometry import shape as make_shape
+from image_ops import block_mean_downsample
+from annotation_handling import save_annotation, load_annotation, polygons_from_rings, union_by_id
+from local_cache import get_cache_dir, cache_key, get_etag, atomic_save
 
 class DharaniHelper:
     """
@@ -23,15 +25,83 @@ class DharaniHelper:
         self.specimennum = specimennum
         self.downsample = downsample
         self.s3 = s3fs.S3FileSystem(anon=True)
+        self._manifest = None
+
+    def _manifest_path(self):
+        return os.path.join(get_cache_dir('manifests'), f'specimen_{self.specimennum}.json')
+
+    def get_manifest(self, refresh=False, with_levels=False):
+        """
+        secnum: {'tif', 'tif_size', 'tif_etag', 'json', 'json_size', 'json_etag', 'has_annotation', 'levels'}
+
+        built once from a single listing of the specimen on s3 and stored locally, so later lookups 
+        need no network access
+
+        refresh : list again; pyramid levels are re-read only for tifs whose ETag changed
+        with_levels : also fill 'levels' = [[width, height], ...] per pyramid level (reads tif metadata)
+        """
+        if self._manifest is None and os.path.exists(self._manifest_path()): # also the baseline for a refresh
+            with open(self._manifest_path()) as fp:
+                self._manifest = {int(k):v for k,v in json.load(fp).items()}
+
+        missing_levels = with_levels and self._manifest is not None and \
+            any([rec['tif'] is not None and rec['levels'] is None for rec in self._manifest.values()])
+
+        if self._manifest is None or refresh or missing_levels:
+            self._manifest = self._build_manifest(self._manifest or {}, with_levels, refresh)
+            atomic_save(self._manifest_path(), lambda fp: fp.write(json.dumps(self._manifest).encode('utf-8')))
+
+        return self._manifest
+
+    def _build_manifest(self, previous, with_levels, refresh=False):
+        manifest = {}
+        prefix = f'dharani-fetal-brain-atlas/data2d/specimen_{self.specimennum}'
+        if refresh:
+            self.s3.invalidate_cache(prefix) # s3fs instances are shared and keep their listings
+        for elt in self.s3.ls(prefix, detail=True, refresh=refresh):
+            fname = os.path.basename(elt['name'])
+            stem, ext = os.path.splitext(fname)
+            if ext not in ('.tif', '.json'):
+                continue
+            secnum = int(stem.split('_')[-1])
+            rec = manifest.setdefault(secnum, {'tif':None, 'tif_size':None, 'tif_etag':None, 
+                                               'json':None, 'json_size':None, 'json_etag':None,
+                                               'has_annotation':False, 'levels':None})
+            kind = ext[1:]
+            rec[kind] = elt['name']
+            rec[kind+'_size'] = elt['size']
+            rec[kind+'_etag'] = str(elt.get('ETag', '')).strip('"')
+            rec['has_annotation'] = rec['json'] is not None
+
+        toread = []
+        for secnum, rec in manifest.items():
+            prev = previous.get(secnum)
+            if prev is not None and prev['tif_etag'] == rec['tif_etag']:
+                rec['levels'] = prev['levels']
+            if with_levels and rec['tif'] is not None and rec['levels'] is None:
+                toread.append(secnum)
+
+        def read_levels(secnum):
+            accessor = PyrTifAccessor('s3://'+manifest[secnum]['tif'], fs=self.s3)
+            return [[lev['pages'][0]['imagewidth'], lev['pages'][0]['imagelength']] 
+                    for lev in accessor.infodict['series'][0]['levels']]
+
+        with ThreadPoolExecutor(8) as pool:
+            for secnum, levels in zip(toread, pool.map(read_levels, toread)):
+                manifest[secnum]['levels'] = levels
+
+        return manifest
 
     def get_section_numbers(self):
-        secnumbers = []
-        for elt in self.s3.ls(f'dharani-fetal-brain-atlas/data2d/specimen_{self.specimennum}'):
-            if elt.endswith('.tif'):
-                fname = os.path.basename(elt)
-                secnum = fname.split('_')[-1][:-4]
-                secnumbers.append(int(secnum))
-        return secnumbers
+        return [secnum for secnum, rec in self.get_manifest().items() if rec['tif'] is not None]
+
+    def has_section(self, secnum:int):
+        rec = self.get_manifest().get(secnum)
+        return rec is not None and rec['tif'] is not None
+
+    def has_annotation(self, secnum:int):
+        rec = self.get_manifest().get(secnum)
+        return rec is not None and rec['has_annotation']
 
     def get_section_urls(self, secnum:int):
         baseurl_s3 = 's3://dharani-fetal-brain-atlas'
@@ -42,64 +112,149 @@ class DharaniHelper:
     
     def get_sectionimage(self, secnum):
         s3url = f's3://dharani-fetal-brain-atlas/data2d/specimen_{self.specimennum}/Specimen_{self.specimennum}_{secnum}.tif'
-        accessor = PyrTifAccessor(s3url)
+        accessor = PyrTifAccessor(s3url, fs=self.s3)
         maxlevel = len(accessor.infodict['series'][0]['levels'])-1
-        assert self.downsample > 2, "Section image access for mpp<8 not supported"
-        lev = self.downsample
-        postresizefactor = 1
-        if self.downsample > maxlevel:
-            lev = maxlevel
-            postresizefactor = 2**(self.downsample - lev)
+
+        # cheapest source for mpp=2^downsample: the coarsest pyramid level that is fine enough,
+        # then JPEG DCT scaling (1/2..1/8) while decoding its tiles, and a resize only for the rest
+        lev = min(self.downsample, maxlevel)
+        reduce = 1
+        if accessor.is_tiled_jpeg(0,lev,0):
+            reduce = 2**min(self.downsample - lev, 3)
+        postresizefactor = 2**(self.downsample - lev) // reduce
         
-        page = accessor.get_page(0,lev,0)
+        page = accessor.get_page(0,lev,0,reduce=reduce)
 
         if postresizefactor > 1:
-            shp = page.shape
-            out = np.zeros((shp[0]//postresizefactor, shp[1]//postresizefactor, shp[2]),page.dtype)
-            for ch in range(3):
-                out[...,ch] = zoom(page[...,ch],1/postresizefactor)
+            out = block_mean_downsample(page, postresizefactor)
         else:
             out = page
         return out
 
-    def get_annotation(self, secnum):
+    def get_annotation(self, secnum, use_cache=True):
+        """
+        ontoid:shape dict at mpp=2^downsample
+
+        use_cache : processed shapes are kept locally as WKB (see annotation_handling.save_annotation),
+                    keyed by specimen, section, downsample and the ETag of the json on s3
+                    (plus a tag of the ingest version, 'holes': rings beyond the first are kept as holes)
+        """
+        jsonpath = f'dharani-fetal-brain-atlas/data2d/specimen_{self.specimennum}/Specimen_{self.specimennum}_{secnum}.json'
+
+        if not use_cache:
+            return self._read_annotation(jsonpath)
+
+        etag = get_etag(self.s3, jsonpath)
+        cachepath = os.path.join(get_cache_dir('annotations'), 
+                                 cache_key(self.specimennum, secnum, self.downsample, etag, 'holes')+'.npz')
+        if os.path.exists(cachepath):
+            try:
+                return load_annotation(cachepath)
+            except (OSError, ValueError, KeyError):
+                pass # unreadable cache file, rebuild below
+
+        outdict = self._read_annotation(jsonpath)
+        atomic_save(cachepath, lambda fp: save_annotation(fp, outdict))
+        return outdict
+
+    def _read_annotation(self, jsonpath):
         
-        jsonpath = f'data2d/specimen_{self.specimennum}/Specimen_{self.specimennum}_{secnum}.json'    
-        with self.s3.open('dharani-fetal-brain-atlas/'+jsonpath) as fp:
+        with self.s3.open(jsonpath) as fp:
             annot = json.load(fp)
             # {type: featurecollection, features: [features] }
 
-        # aggregate by ontoid
-        shapes = defaultdict(list)
+        # all polygons (with their holes) built and repaired at once, then merged per ontoid
         mpp = 2**self.downsample
+        ontoids, rings, polyidx = [], [], [] # one ontoid per polygon, polygon index of each ring
         for feat in annot['features']:
-            ontoid = feat['properties']['data']['id']
-            coordinates = np.abs(np.array(feat['geometry']['coordinates'])).squeeze()/mpp
+            geom = feat['geometry']
+            if geom['type'] == 'Polygon':
+                polygons = [geom['coordinates']]
+            elif geom['type'] == 'MultiPolygon':
+                polygons = geom['coordinates']
+            else:
+                raise ValueError(f"unsupported geometry type {geom['type']} in {jsonpath}")
 
-            updatedgeom = {
-                'type':feat['geometry']['type'],
-                'coordinates': [coordinates.tolist()]
-                           }
-        
-            shape = make_shape(updatedgeom).buffer(0)
-            shapes[ontoid].append(shape)
+            for polygon in polygons:
+                if len(polygon) == 0:
+                    continue
+                for ring in polygon:
+                    ring = np.abs(np.asarray(ring, dtype=float)).squeeze()
+                    if ring.ndim != 2 or ring.shape[1] != 2:
+                        raise ValueError(f'malformed ring of shape {ring.shape} in {jsonpath}')
+                    rings.append(ring/mpp)
+                    polyidx.append(len(ontoids))
+                ontoids.append(feat['properties']['data']['id'])
 
-        # revisit and make multi
-        
-        outdict = {}
-        for ontoid,shplist in shapes.items():
-            united = None
-            for shp in shplist:
-                if united is None:
-                    united = shp
-                else:
-                    united = united.union(shp)
-
-            outdict[ontoid]=united
-        return outdict
+        shapes = polygons_from_rings(rings, make_valid=True, polyidx=polyidx)
+        return union_by_id(ontoids, shapes)
 
     def get_viewer_url(self, secnum):
         baseurl = 'https://dharani.humanbrain.in'
         url = f'{baseurl}/code/2dviewer/annotation/public?data={self.specimennum-1}&region=-1&section={secnum}'
         return url
-    
\ No newline at end of file
+    
+
+    def _load_section_part(self, secnum, what):
+        if what == 'image':
+            return self.get_sectionimage(secnum)
+        if what == 'annotation':
+            try:
+                return self.get_annotation(secnum)
+            except FileNotFoundError: # section not annotated
+                return None
+        raise ValueError(f'unknown section part {what}')
+
+    def iter_sections(self, secnums=None, what=('image','annotation'), workers=4, prefetch=None, ordered=True):
+        """
+        yields (secnum, {'image':..., 'annotation':...}) for many sections, loaded on a thread pool
+        that shares this helper's s3 filesystem (annotation is None for non-annotated sections)
+
+        secnums : defaults to get_section_numbers()
+        what : any of 'image', 'annotation'; each part of each section is a separate task
+        prefetch : max. sections in flight (default 2*workers), bounds memory when the consumer is slow
+        ordered : yield in the order of secnums, else as sections complete
+        """
+        if secnums is None:
+            secnums = self.get_section_numbers()
+            if 'annotation' in what and 'image' not in what:
+                secnums = [secnum for secnum in secnums if self.has_annotation(secnum)]
+        if prefetch is None:
+            prefetch = 2*workers
+        secnums = iter(secnums)
+
+        with ThreadPoolExecutor(workers) as pool:
+            inflight = deque() # (secnum, {part: future})
+
+            def submit(secnum):
+                inflight.append((secnum, {part: pool.submit(self._load_section_part, secnum, part) for part in what}))
+
+            for secnum in itertools.islice(secnums, prefetch):
+                submit(secnum)
+
+            try:
+                while len(inflight) > 0:
+                    idx = 0
+                    if not ordered:
+                        idx = None
+                        while idx is None:
+                            for ii, (_, futures) in enumerate(inflight):
+                                if all([fut.done() for fut in futures.values()]):
+                                    idx = ii
+                                    break
+                            else:
+                                wait([fut for _, futures in inflight for fut in futures.values() if not fut.done()],
+                                     return_when=FIRST_COMPLETED)
+
+                    secnum, futures = inflight[idx]
+                    del inflight[idx]
+                    result = {part: fut.result() for part, fut in futures.items()}
+
+                    for nextsecnum in itertools.islice(secnums, 1): # keep the pipeline full
+                        submit(nextsecnum)
+
+                    yield secnum, result
+            finally:
+                for _, futures in inflight: # consumer stopped early or a load failed
+                    for fut in futures.values():
+                        fut.cancel()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from local_cache import get_cache_dir, cache_key, atomic_save
+
+# shared http layer: one keep-alive session (connection pool + retries with backoff) and an on-disk cache
+# of GET responses keyed by url, revalidated with ETag/Last-Modified once older than max_age
+
+ALLEN_API_URL = os.environ.get('ALLEN_API_URL', 'http://api.brain-map.org') # e.g. a local stand-in server
+
+DEFAULT_TIMEOUT = 500
+DEFAULT_MAX_AGE = 7*24*3600 # seconds before a cached response is revalidated, None: always revalidate
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ process-wide requests.Session with a connection pool and retry/backoff on transient errors """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET', 'HEAD'), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+class HttpResponse:
+    """
+    the part of requests.Response used in this package, served from the cache file or from the network;
+    network bodies are written to the cache while they are read (complete reads only)
+    """
+    def __init__(self, url, status_code, response=None, path=None, cachepath=None, meta=None):
+        self.url = url
+        self.status_code = status_code
+        self.from_cache = response is None
+        self._response = response
+        self._path = path
+        self._cachepath = cachepath
+        self._meta = meta
+        self._content = None
+
+    @property
+    def version(self):
+        """ ETag (or Last-Modified) of the body, None if the server sent neither """
+        if self._meta is None:
+            return None
+        return self._meta.get('etag') or self._meta.get('last_modified')
+
+    def iter_content(self, chunk_size=1<<16):
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start+chunk_size]
+
+        elif self._response is None:
+            with open(self._path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b''):
+                    yield chunk
+
+        elif self._cachepath is None:
+            yield from self._response.iter_content(chunk_size=chunk_size)
+
+        else:
+            tmppath = '%s.%d.%d.tmp' % (self._cachepath, os.getpid(), threading.get_ident())
+            try:
+                with open(tmppath, 'wb') as fp:
+                    for chunk in self._response.iter_content(chunk_size=chunk_size):
+                        fp.write(chunk)
+                        yield chunk
+                os.replace(tmppath, self._cachepath)
+                atomic_save(self._cachepath+'.json', lambda fp: fp.write(json.dumps(self._meta).encode('utf-8')))
+            finally:
+                if os.path.exists(tmppath):
+                    os.remove(tmppath)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b''.join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def http_get(url:str, use_cache=True, max_age=DEFAULT_MAX_AGE, timeout=DEFAULT_TIMEOUT, stream=False):
+    """
+    GET through the shared session; successful responses are cached on disk (keyed by url) and served
+    from there while fresher than max_age, then revalidated (If-None-Match / If-Modified-Since);
+    the cached copy is also served when the server cannot be reached.
+    stream: the body is downloaded while iter_content() is consumed, otherwise right away
+    """
+    cachepath = os.path.join(get_cache_dir('http'), cache_key(url)) if use_cache else None
+    meta = None
+    if cachepath is not None and os.path.exists(cachepath+'.json'):
+        with open(cachepath+'.json') as fp:
+            meta = json.load(fp)
+        if max_age is not None and time.time() - meta['time'] < max_age:
+            return HttpResponse(url, 200, path=cachepath, meta=meta)
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = get_session().get(url, headers=headers, timeout=timeout, stream=True)
+    except requests.ConnectionError:
+        if meta is None:
+            raise
+        return HttpResponse(url, 200, path=cachepath, meta=meta)
+
+    if meta is not None and response.status_code == 304:
+        response.close()
+        meta['time'] = time.time()
+        atomic_save(cachepath+'.json', lambda fp: fp.write(json.dumps(meta).encode('utf-8')))
+        return HttpResponse(url, 200, path=cachepath, meta=meta)
+
+    if response.status_code != 200:
+        cachepath = None # not cached
+    newmeta = {'url':url, 'time':time.time(), 'etag':response.headers.get('ETag'),
+               'last_modified':response.headers.get('Last-Modified')}
+    out = HttpResponse(url, response.status_code, response=response, cachepath=cachepath, meta=newmeta)
+    if not stream:
+        out.content
+        out.close()
+    return out
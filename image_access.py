@@ -4,38 +4,279 @@ import fsspec
 from PIL import Image
 import numpy as np
 from io import BytesIO
+import json
+import os
+import threading
+import asyncio
+import functools
+import weakref
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from local_cache import get_cache_dir, cache_key, get_etag, atomic_save
+
+
+def decode_jpeg_tile(jpegtables, raw_tile, reduce=1):
+    """ reduce: 1, 2, 4 or 8; >1 uses JPEG DCT scaling, i.e. decodes directly at 1/reduce size """
+    pil_tile = Image.open(BytesIO(jpegtables + raw_tile))
+    if reduce > 1:
+        size = (pil_tile.width // reduce, pil_tile.height // reduce)
+        pil_tile.draft(pil_tile.mode, size)
+        if pil_tile.size != size: # not scalable by the decoder
+            pil_tile = pil_tile.reduce(reduce)
+    return np.array(pil_tile)
+
+
+def plan_tile_reads(dataoffsets, databytecounts, tile_index_list, max_gap=16*1024, max_request=8*1024*1024):
+    """
+    coalesce tile reads into a few large byte ranges
+
+    tiles are sorted by file offset, and neighbours are merged into one range if the
+    gap between them is <= max_gap bytes and the merged range stays <= max_request bytes
+
+    returns [(start, end, [(tile_index, relstart, relend), ...]), ...] with end exclusive
+    """
+    tile_indices = np.unique(np.asarray(tile_index_list, dtype=np.int64))
+    offsets = np.asarray(dataoffsets, dtype=np.int64)[tile_indices]
+    ends = offsets + np.asarray(databytecounts, dtype=np.int64)[tile_indices]
+
+    order = np.argsort(offsets, kind='stable')
+
+    ranges = []
+    for ii in order:
+        tidx, tstart, tend = int(tile_indices[ii]), int(offsets[ii]), int(ends[ii])
+        if len(ranges) > 0:
+            rstart, rend, members = ranges[-1]
+            if tstart - rend <= max_gap and max(rend, tend) - rstart <= max_request:
+                members.append((tidx, tstart, tend))
+                ranges[-1] = (rstart, max(rend, tend), members)
+                continue
+        ranges.append((tstart, tend, [(tidx, tstart, tend)]))
+
+    return [(rstart, rend, [(tidx, tstart-rstart, tend-rstart) for tidx, tstart, tend in members])
+            for rstart, rend, members in ranges]
+
+
+def reduce_region(left, top, width, height, reduce):
+    """ region in pixels of a page -> region on the 1/reduce grid (outward rounding) """
+    if reduce == 1:
+        return left, top, width, height
+    right = -(-(left + width) // reduce)
+    bottom = -(-(top + height) // reduce)
+    return left // reduce, top // reduce, right - left // reduce, bottom - top // reduce
+
+
+def _writable(np_tile):
+    """ tiles served from a TileCache are read-only, callers get their own copy """
+    return np_tile if np_tile.flags.writeable else np_tile.copy()
+
+
+class TileCache:
+    """
+    LRU cache of decoded tiles keyed by (url, seriesnum, levelnum, pagenum, tile_index, reduce), 
+    bounded by the total nbytes of the cached arrays. Cached tiles are read-only.
+
+    disk_dir : optional second tier keeping the compressed tile bytes on local disk (not evicted),
+               so that a fresh process only decodes instead of going back to s3
+    """
+    def __init__(self, max_bytes=256*1024*1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.nbytes = 0
+        self.stats = {'hits':0, 'misses':0, 'evictions':0, 'disk_hits':0}
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        with self._lock:
+            np_tile = self._tiles.get(key)
+            if np_tile is None:
+                self.stats['misses'] += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.stats['hits'] += 1
+            return np_tile
+
+    def put(self, key, np_tile):
+        """ takes ownership of np_tile (freshly decoded, not shared), which is made read-only """
+        np_tile.flags.writeable = False
+        with self._lock:
+            if key in self._tiles:
+                self.nbytes -= self._tiles.pop(key).nbytes
+            self._tiles[key] = np_tile
+            self.nbytes += np_tile.nbytes
+            while self.nbytes > self.max_bytes and len(self._tiles) > 0:
+                _, evicted = self._tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+    def _raw_path(self, key, version):
+        url, seriesnum, levelnum, pagenum, tile_index = key[:5] # same bytes for any reduce
+        return os.path.join(self.disk_dir, cache_key(url, version), f'{seriesnum}_{levelnum}_{pagenum}_{tile_index}.bin')
+
+    def get_raw(self, key, version):
+        """ compressed tile bytes from the disk tier, version is the ETag of the object """
+        if self.disk_dir is None:
+            return None
+        try:
+            with open(self._raw_path(key, version), 'rb') as fp:
+                raw_tile = fp.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.stats['disk_hits'] += 1
+        return raw_tile
+
+    def put_raw(self, key, version, raw_tile):
+        if self.disk_dir is None:
+            return
+        path = self._raw_path(key, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_save(path, lambda fp: fp.write(raw_tile))
+
+
+# shared by all accessors unless one is passed explicitly
+DEFAULT_TILE_CACHE = TileCache()
+
 
 class PyrTifAccessor:
-    def __init__(self,s3_url):
-        self.fs = fsspec.filesystem("s3",anon=True)
+    def __init__(self,s3_url,use_cache=True,max_gap=16*1024,max_request=8*1024*1024,
+                 max_workers=1,decode_processes=False,max_inflight_bytes=64*1024*1024,
+                 tile_cache=DEFAULT_TILE_CACHE,fs=None):
+        """
+        s3_url : s3://bucket/path/to/pyramidal.tif
+
+        use_cache : tile offsets, bytecounts and jpeg tables of all pages are parsed once 
+                    and kept in a local sidecar file (keyed by url+ETag), so later instances 
+                    for the same object skip TIFF parsing altogether
+
+        max_gap, max_request : byte range coalescing for multi-tile reads (see plan_tile_reads)
+
+        max_workers : >1 fetches byte ranges on a thread pool and decodes tiles concurrently
+                      (pools are kept for the accessor's lifetime, see close())
+        decode_processes : decode on a process pool (of max_workers) instead of threads
+        max_inflight_bytes : cap on compressed bytes requested but not yet decoded
+
+        tile_cache : TileCache for decoded tiles, shared across accessors by default; None disables it
+
+        fs : fsspec filesystem to read through (e.g. a shared s3fs instance), default anonymous s3
+        """
+        if fs is None:
+            fs = fsspec.filesystem("s3",anon=True)
+        self.fs = fs
         
         self.url = s3_url
 
+        self.max_gap = max_gap
+        self.max_request = max_request
+
+        self.max_workers = max_workers
+        self.decode_processes = decode_processes
+        self.max_inflight_bytes = max_inflight_bytes
+        self._pools = None # (iopool, decodepool), created on the first concurrent read, reused until close()
+        self._pools_lock = threading.Lock()
+
+        self.tile_cache = tile_cache
+        self._etag = None
+
+        self.read_stats = {'requests':0, 'bytes':0} # cumulative
+        self.last_read_stats = {'requests':0, 'bytes':0} # of the latest get_tile(s)/get_region call
+
+        self.infodict = {'series':[]}
+        self.pagedata = {} # (seriesnum,levelnum,pagenum): {'dataoffsets','databytecounts','jpegtables'}
+
+        cachepath = None
+        if use_cache:
+            cachepath = os.path.join(get_cache_dir('tifmeta'), cache_key(self.url, self.etag)+'.npz')
+            if os.path.exists(cachepath):
+                try:
+                    self._load_metadata(cachepath)
+                    return
+                except (OSError, ValueError, KeyError):
+                    pass # unreadable sidecar, parse again and overwrite
+
+        self._parse_metadata()
+        if cachepath is not None:
+            atomic_save(cachepath, self._save_metadata)
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = get_etag(self.fs, self.url)
+        return self._etag
+
+    def _parse_metadata(self):
         self.infodict = {'series':[]}
+        self.pagedata = {}
 
         with self.fs.open(self.url, 'rb', block_size=1024) as fp:
             with TiffFile(fp) as tif:
 
-                for ser in tif.series:
+                for sernum,ser in enumerate(tif.series):
                     levels = {'levels':[]}
                     
-                    for lev in ser.levels:
+                    for levnum,lev in enumerate(ser.levels):
                         pages = {'pages':[]}
-                        for page in lev.pages:
+                        for pagenum,page in enumerate(lev.pages):
                             pages['pages'].append({
                                 'imagewidth':page.imagewidth,
+                                'imagelength':page.imagelength,
                                 'tilewidth':page.tilewidth,
                                 'tilelength':page.tilelength,
                                 'dtype':page.dtype,
                                 'compression':page.compression,
                                 'samplesperpixel':page.samplesperpixel, # channels
-                                'tiles_per_row': (page.imagewidth + page.tilewidth -1) // page.tilewidth,
-                                'tiles_per_column': (page.imagelength+page.tilelength-1)//page.tilelength,
+                                'tiles_per_row': (page.imagewidth + page.tilewidth -1) // max(page.tilewidth,1),
+                                'tiles_per_column': (page.imagelength+page.tilelength-1)//max(page.tilelength,1),
                             })
+                            self.pagedata[(sernum,levnum,pagenum)] = {
+                                'dataoffsets': np.asarray(page.dataoffsets, dtype=np.uint64),
+                                'databytecounts': np.asarray(page.databytecounts, dtype=np.uint64),
+                                'jpegtables': page.jpegtables or b'',
+                            }
                         levels['levels'].append(pages)
 
                     self.infodict['series'].append(levels)
 
+    def _save_metadata(self, fp):
+        info = {'series':[{'levels':[{'pages':[
+                    dict(pinfo, dtype=str(pinfo['dtype']), compression=int(pinfo['compression']))
+                    for pinfo in lev['pages']]}
+                for lev in ser['levels']]}
+            for ser in self.infodict['series']]}
+
+        arrays = {'infodict': np.array(json.dumps(info))}
+        for (sernum,levnum,pagenum),pdata in self.pagedata.items():
+            key = f'{sernum}_{levnum}_{pagenum}'
+            arrays['dataoffsets_'+key] = pdata['dataoffsets']
+            arrays['databytecounts_'+key] = pdata['databytecounts']
+            arrays['jpegtables_'+key] = np.frombuffer(pdata['jpegtables'], dtype=np.uint8)
+        np.savez(fp, **arrays)
+
+    def _load_metadata(self, cachepath):
+        with np.load(cachepath, allow_pickle=False) as npz:
+            info = json.loads(str(npz['infodict']))
+            pagedata = {}
+            for sernum,ser in enumerate(info['series']):
+                for levnum,lev in enumerate(ser['levels']):
+                    for pagenum,pinfo in enumerate(lev['pages']):
+                        pinfo['dtype'] = np.dtype(pinfo['dtype'])
+                        key = f'{sernum}_{levnum}_{pagenum}'
+                        pagedata[(sernum,levnum,pagenum)] = {
+                            'dataoffsets': npz['dataoffsets_'+key],
+                            'databytecounts': npz['databytecounts_'+key],
+                            'jpegtables': npz['jpegtables_'+key].tobytes(),
+                        }
+        self.infodict = info
+        self.pagedata = pagedata
 
     def get_info(self,seriesnum=None,levelnum=None,pagenum=None):
         if seriesnum is None:
@@ -46,57 +287,193 @@ class PyrTifAccessor:
             return self.infodict['series'][seriesnum]['levels'][levelnum]
         return self.infodict['series'][seriesnum]['levels'][levelnum]['pages'][pagenum]
     
-    def get_page(self,seriesnum,levelnum,pagenum):
+    def is_tiled_jpeg(self,seriesnum,levelnum,pagenum):
+        info = self.get_info(seriesnum,levelnum,pagenum)
+        return info['tilewidth'] > 0 and info['compression'] == 7
+
+    def get_page(self,seriesnum,levelnum,pagenum,reduce=1):
+        """ reduce : 1, 2, 4 or 8 (tiled jpeg pages only), see get_region """
+        if self.is_tiled_jpeg(seriesnum,levelnum,pagenum): # assemble from tiles
+            info = self.get_info(seriesnum,levelnum,pagenum)
+            return self.get_region(seriesnum,levelnum,pagenum,0,0,info['imagewidth'],info['imagelength'],reduce=reduce)
+        assert reduce == 1, "reduced decoding requires tiled jpeg pages"
+
         with self.fs.open(self.url, 'rb', block_size=4*1024) as fp:
             with TiffFile(fp) as tif:
                 page = tif.series[seriesnum].levels[levelnum].pages[pagenum]
                 return page.asarray()
 
-    def get_tile(self,seriesnum,levelnum,pagenum,tile_index):
-        np_tile = None
-        with self.fs.open(self.url, 'rb', block_size=4*1024) as fp:
-            with TiffFile(fp) as tif:
-                
-                page = tif.series[seriesnum].levels[levelnum].pages[pagenum]
-                offset = page.dataoffsets[tile_index]
-                byte_count = page.databytecounts[tile_index]
+    def _plan_reads(self,seriesnum,levelnum,pagenum,tile_index_list,num_splits=None):
+        pdata = self.pagedata[(seriesnum,levelnum,pagenum)]
+        max_request = self.max_request
+        if num_splits is None:
+            num_splits = self.max_workers
+        if num_splits > 1: # split into at least num_splits ranges, so that fetches can overlap
+            tile_indices = np.unique(np.asarray(tile_index_list, dtype=np.int64))
+            total_bytes = int(pdata['databytecounts'][tile_indices].sum())
+            max_request = min(max_request, max(total_bytes // num_splits, 1))
+        return plan_tile_reads(pdata['dataoffsets'], pdata['databytecounts'], tile_index_list, 
+                               self.max_gap, max_request)
+
+    def _read_tiles_bytes(self,seriesnum,levelnum,pagenum,tile_index_list):
+        plan = self._plan_reads(seriesnum,levelnum,pagenum,tile_index_list)
+        if len(plan) == 0:
+            self._update_read_stats(0, 0)
+            return {}
+
+        starts = [rstart for rstart,_,_ in plan]
+        ends = [rend for _,rend,_ in plan]
+        buffers = self.fs.cat_ranges([self.url]*len(plan), starts, ends) # bulk ranged GETs
+        self._update_read_stats(len(plan), sum(ends) - sum(starts))
+
+        raw_tiles = {}
+        for (_,_,members), buf in zip(plan, buffers):
+            for tidx, relstart, relend in members:
+                raw_tiles[tidx] = buf[relstart:relend]
+                self._put_raw_tile(seriesnum,levelnum,pagenum,tidx,raw_tiles[tidx])
+        return raw_tiles
+
+    def _update_read_stats(self, numrequests, numbytes):
+        self.last_read_stats = {'requests':numrequests, 'bytes':numbytes}
+        self.read_stats['requests'] += numrequests
+        self.read_stats['bytes'] += numbytes
+
+    def _decode_tile(self,seriesnum,levelnum,pagenum,raw_tile,reduce=1):
+        jpegtables = self.pagedata[(seriesnum,levelnum,pagenum)]['jpegtables']
+        return decode_jpeg_tile(jpegtables, raw_tile, reduce)
 
-                fp.seek(offset)
-                raw_tile = fp.read(byte_count)
+    def _iter_tiles_concurrent(self,seriesnum,levelnum,pagenum,tile_index_list,reduce=1):
+        # fetch ranges on an io thread pool and decode each tile as soon as its range arrives,
+        # holding at most max_inflight_bytes of compressed data (at least one range) at a time
+        jpegtables = self.pagedata[(seriesnum,levelnum,pagenum)]['jpegtables']
+        plan = deque(self._plan_reads(seriesnum,levelnum,pagenum,tile_index_list))
+        self._update_read_stats(len(plan), sum([rend-rstart for rstart,rend,_ in plan]))
 
-                pil_tile = Image.open(BytesIO(page.jpegtables + raw_tile))
-                np_tile = np.array(pil_tile)
+        iopool, decodepool = self._get_pools()
+        pending = {} # future: (kind, payload, numbytes)
+        inflight_bytes = 0
+        try:
+            while len(plan) > 0 or len(pending) > 0:
+                while len(plan) > 0 and (inflight_bytes == 0 or 
+                                         inflight_bytes + plan[0][1] - plan[0][0] <= self.max_inflight_bytes):
+                    rstart, rend, members = plan.popleft()
+                    fut = iopool.submit(self.fs.cat_file, self.url, start=rstart, end=rend)
+                    pending[fut] = ('fetch', members, rend-rstart)
+                    inflight_bytes += rend-rstart
 
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    kind, payload, numbytes = pending.pop(fut)
+                    if kind == 'fetch':
+                        buf = fut.result()
+                        for tidx, relstart, relend in payload:
+                            self._put_raw_tile(seriesnum,levelnum,pagenum,tidx,buf[relstart:relend])
+                            decodefut = decodepool.submit(decode_jpeg_tile, jpegtables, buf[relstart:relend], reduce)
+                            pending[decodefut] = ('decode', tidx, relend-relstart)
+                        inflight_bytes -= numbytes - sum([relend-relstart for _,relstart,relend in payload]) # gaps
+                    else:
+                        inflight_bytes -= numbytes
+                        yield payload, fut.result()
+        finally:
+            for fut in pending: # abandoned or failed: don't leave work queued on the shared pools
+                fut.cancel()
+
+    def _get_pools(self):
+        with self._pools_lock:
+            if self._pools is None:
+                DecodeExecutor = ProcessPoolExecutor if self.decode_processes else ThreadPoolExecutor
+                self._pools = (ThreadPoolExecutor(self.max_workers), DecodeExecutor(self.max_workers))
+            return self._pools
+
+    def close(self):
+        """ shuts down the fetch/decode pools (max_workers > 1); they are recreated if the accessor is used again """
+        with self._pools_lock:
+            pools, self._pools = self._pools, None
+        if pools is not None:
+            for pool in pools:
+                pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_pools', None) is not None:
+            self.close()
+
+    def _iter_tiles_serial(self,seriesnum,levelnum,pagenum,tile_index_list,reduce=1):
+        raw_tiles = self._read_tiles_bytes(seriesnum,levelnum,pagenum,tile_index_list)
+        for tile_index in list(raw_tiles):
+            yield tile_index, self._decode_tile(seriesnum,levelnum,pagenum,raw_tiles.pop(tile_index),reduce)
+
+    def _get_cached_tile(self,seriesnum,levelnum,pagenum,tile_index,reduce=1):
+        if self.tile_cache is None:
+            return None
+        key = (self.url,seriesnum,levelnum,pagenum,tile_index,reduce)
+        np_tile = self.tile_cache.get(key)
+        if np_tile is None and self.tile_cache.disk_dir is not None:
+            raw_tile = self.tile_cache.get_raw(key, self.etag)
+            if raw_tile is not None:
+                np_tile = self._decode_tile(seriesnum,levelnum,pagenum,raw_tile,reduce)
+                self.tile_cache.put(key, np_tile)
         return np_tile
 
+    def _put_raw_tile(self,seriesnum,levelnum,pagenum,tile_index,raw_tile):
+        if self.tile_cache is not None and self.tile_cache.disk_dir is not None:
+            self.tile_cache.put_raw((self.url,seriesnum,levelnum,pagenum,tile_index), self.etag, raw_tile)
 
-    def get_tiles(self,seriesnum,levelnum,pagenum,tile_index_list):
+    def _iter_tiles(self,seriesnum,levelnum,pagenum,tile_index_list,reduce=1):
+        """ yields (tile_index, np_tile) for the unique tile indices, cached ones first, then in completion order """
+        assert reduce in (1,2,4,8), "reduce must be 1, 2, 4 or 8"
+        missing = []
+        for tile_index in dict.fromkeys(tile_index_list):
+            np_tile = self._get_cached_tile(seriesnum,levelnum,pagenum,tile_index,reduce)
+            if np_tile is None:
+                missing.append(tile_index)
+            else:
+                yield tile_index, np_tile
 
-        out_tiles = {}
-        with self.fs.open(self.url, 'rb', block_size=4*1024) as fp:
-            with TiffFile(fp) as tif:
-                
-                page = tif.series[seriesnum].levels[levelnum].pages[pagenum]
+        if len(missing) == 0:
+            self._update_read_stats(0, 0)
+            return
+
+        if self.max_workers > 1:
+            fetched = self._iter_tiles_concurrent(seriesnum,levelnum,pagenum,missing,reduce)
+        else:
+            fetched = self._iter_tiles_serial(seriesnum,levelnum,pagenum,missing,reduce)
+
+        for tile_index, np_tile in fetched:
+            if self.tile_cache is not None:
+                self.tile_cache.put((self.url,seriesnum,levelnum,pagenum,tile_index,reduce), np_tile)
+            yield tile_index, np_tile
 
-                for tile_index in tile_index_list:
-                    offset = page.dataoffsets[tile_index]
-                    byte_count = page.databytecounts[tile_index]
+    def get_tile(self,seriesnum,levelnum,pagenum,tile_index,reduce=1):
+        _, np_tile = next(self._iter_tiles(seriesnum,levelnum,pagenum,[tile_index],reduce))
+        return _writable(np_tile)
 
-                    fp.seek(offset)
-                    raw_tile = fp.read(byte_count)
 
-                    pil_tile = Image.open(BytesIO(page.jpegtables + raw_tile))
-                    out_tiles[tile_index] = np.array(pil_tile)
+    def get_tiles(self,seriesnum,levelnum,pagenum,tile_index_list,reduce=1):
+
+        decoded = dict(self._iter_tiles(seriesnum,levelnum,pagenum,tile_index_list,reduce))
+
+        out_tiles = {}
+        for tile_index in tile_index_list:
+            out_tiles[tile_index] = _writable(decoded[tile_index])
         
         return out_tiles
 
 
-    def get_region(self,seriesnum,levelnum,pagenum,left,top,width,height):
-        
+    def _prepare_region(self,seriesnum,levelnum,pagenum,left,top,width,height,out=None,reduce=1):
+        """ 
+        returns the (allocated or checked) output array and the tile indices covering the region 
+        left, top, width, height are in the reduced pixel grid (see get_region)
+        """
         info = self.infodict['series'][seriesnum]['levels'][levelnum]['pages'][pagenum]
 
-        tile_width = info['tilewidth']
-        tile_height = info['tilelength']
+        tile_width = info['tilewidth'] // reduce
+        tile_height = info['tilelength'] // reduce
 
         tiles_per_row = info['tiles_per_row']
 
@@ -107,22 +484,191 @@ class PyrTifAccessor:
 
         # print(x_tile_start, y_tile_start, x_tile_end, y_tile_end)
 
-        tile_rows = []
-        for y_tile in range(y_tile_start, y_tile_end + 1):
-            
+        shape = (height, width)
+        if info['samplesperpixel'] > 1:
+            shape += (info['samplesperpixel'],)
+        if out is None:
+            out = np.empty(shape, dtype=info['dtype'])
+        elif out.shape != shape:
+            raise ValueError(f'out has shape {out.shape}, expected {shape}')
+
+        region_tile_indices = [y_tile * tiles_per_row + x_tile 
+                               for y_tile in range(y_tile_start, y_tile_end + 1)
+                               for x_tile in range(x_tile_start, x_tile_end + 1)]
+        return out, region_tile_indices
+
+    def _paste_tile(self,seriesnum,levelnum,pagenum,out,left,top,tile_index,np_tile,reduce=1):
+        """ copies the part of a tile overlapping the region at (left,top) into its window of out """
+        info = self.infodict['series'][seriesnum]['levels'][levelnum]['pages'][pagenum]
+        tile_width = info['tilewidth'] // reduce
+        tile_height = info['tilelength'] // reduce
+        height, width = out.shape[:2]
+
+        tile_x0 = (tile_index % info['tiles_per_row']) * tile_width
+        tile_y0 = (tile_index // info['tiles_per_row']) * tile_height
+
+        x0, x1 = max(left, tile_x0), min(left + width, tile_x0 + tile_width)
+        y0, y1 = max(top, tile_y0), min(top + height, tile_y0 + tile_height)
+
+        out[y0-top:y1-top, x0-left:x1-left] = np_tile[y0-tile_y0:y1-tile_y0, x0-tile_x0:x1-tile_x0]
+
+    def get_region(self,seriesnum,levelnum,pagenum,left,top,width,height,out=None,reduce=1):
+        """
+        region [top:top+height, left:left+width] of a page, as (height, width, channels) array
+
+        out : optional preallocated destination (e.g. np.memmap) of that shape and the page dtype;
+              tiles are decoded one by one straight into their clipped window of it
+
+        reduce : 1, 2, 4 or 8; tiles are decoded at 1/reduce scale (JPEG DCT scaling), and the
+                 result is the region on that reduced grid, of shape (ceil(height/reduce), ceil(width/reduce), channels)
+        """
+        left, top, width, height = reduce_region(left, top, width, height, reduce)
+        out, region_tile_indices = self._prepare_region(seriesnum,levelnum,pagenum,left,top,width,height,out,reduce)
+
+        # all tiles of the region in one coalesced read, each copied into its clipped window
+        for tile_index, np_tile in self._iter_tiles(seriesnum,levelnum,pagenum,region_tile_indices,reduce):
+            self._paste_tile(seriesnum,levelnum,pagenum,out,left,top,tile_index,np_tile,reduce)
+
+        return out
+
+
+_async_fs_by_loop = weakref.WeakKeyDictionary()
+
+async def get_async_s3fs():
+    """ one asynchronous s3 filesystem (and its connection pool) per event loop """
+    loop = asyncio.get_running_loop()
+    fs = _async_fs_by_loop.get(loop)
+    if fs is None:
+        fs = fsspec.filesystem("s3", anon=True, asynchronous=True, skip_instance_cache=True)
+        await fs.set_session()
+        _async_fs_by_loop[loop] = fs
+    return fs
+
+
+_sync_fs_by_async_fs = weakref.WeakKeyDictionary()
+
+def _sync_counterpart(fs):
+    """
+    blocking instance of an async fsspec filesystem's class, same storage options (credentials, endpoint),
+    one per async filesystem so that its accessors share a connection pool
+    """
+    sync_fs = _sync_fs_by_async_fs.get(fs)
+    if sync_fs is None:
+        options = dict(fs.storage_options, asynchronous=False, skip_instance_cache=True)
+        sync_fs = _sync_fs_by_async_fs.setdefault(fs, type(fs)(**options))
+    return sync_fs
+
+
+class AsyncPyrTifAccessor:
+    """
+    asyncio variant of PyrTifAccessor: tile ranges are fetched through an async fsspec filesystem
+    shared by all accessors on the event loop, and decoded in the loop's default executor.
+
+        accessor = await AsyncPyrTifAccessor.open(s3_url)
+        rgn = await accessor.get_region(0,4,0,1500,1000,1000,800,timeout=30)
+
+    Every get_* call accepts timeout (seconds); on timeout or cancellation all of its pending 
+    range requests are cancelled.
+    """
+    def __init__(self, accessor:PyrTifAccessor, fs, max_concurrency=16):
+        self.accessor = accessor # metadata, read planning, tile cache
+        self.url = accessor.url
+        self.infodict = accessor.infodict
+        self.fs = fs
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.read_stats = {'requests':0, 'bytes':0} # cumulative
+
+    @classmethod
+    async def open(cls, s3_url, fs=None, sync_fs=None, max_concurrency=16, **kwargs):
+        """
+        fs : async fsspec filesystem, defaults to get_async_s3fs()
+        sync_fs : blocking filesystem for the metadata read, defaults to a synchronous instance
+            of fs's class with the same storage options (anonymous s3 when fs is not given)
+        max_concurrency : max. range requests in flight for this accessor
+        kwargs : passed on to PyrTifAccessor (use_cache, max_gap, max_request, tile_cache)
+        """
+        if sync_fs is None and fs is not None:
+            sync_fs = _sync_counterpart(fs)
+        if fs is None:
+            fs = await get_async_s3fs()
+        loop = asyncio.get_running_loop()
+        # metadata comes from the sidecar cache, or a one-off TIFF parse off the event loop
+        accessor = await loop.run_in_executor(None, functools.partial(PyrTifAccessor, s3_url, fs=sync_fs, **kwargs))
+        return cls(accessor, fs, max_concurrency)
+
+    def get_info(self,seriesnum=None,levelnum=None,pagenum=None):
+        return self.accessor.get_info(seriesnum,levelnum,pagenum)
+
+    async def _fetch_range(self, rstart, rend):
+        async with self._semaphore:
+            buf = await self.fs._cat_file(self.url, start=rstart, end=rend)
+        self.read_stats['requests'] += 1
+        self.read_stats['bytes'] += rend-rstart
+        return buf
+
+    async def _decode_tile(self,seriesnum,levelnum,pagenum,tile_index,raw_tile,reduce,on_tile):
+        loop = asyncio.get_running_loop()
+        np_tile = await loop.run_in_executor(None, self.accessor._decode_tile, seriesnum,levelnum,pagenum,raw_tile,reduce)
+        if self.accessor.tile_cache is not None:
+            self.accessor.tile_cache.put((self.url,seriesnum,levelnum,pagenum,tile_index,reduce), np_tile)
+        on_tile(tile_index, np_tile)
+
+    async def _fetch_and_decode(self,seriesnum,levelnum,pagenum,rstart,rend,members,reduce,on_tile):
+        buf = await self._fetch_range(rstart, rend)
+        decodes = []
+        for tidx, relstart, relend in members:
+            self.accessor._put_raw_tile(seriesnum,levelnum,pagenum,tidx,buf[relstart:relend])
+            decodes.append(self._decode_tile(seriesnum,levelnum,pagenum,tidx,buf[relstart:relend],reduce,on_tile))
+        await asyncio.gather(*decodes)
+
+    async def _visit_tiles(self,seriesnum,levelnum,pagenum,tile_index_list,reduce,on_tile):
+        # calls on_tile(tile_index, np_tile) once per unique tile, cached ones first
+        assert reduce in (1,2,4,8), "reduce must be 1, 2, 4 or 8"
+        missing = []
+        for tile_index in dict.fromkeys(tile_index_list):
+            np_tile = self.accessor._get_cached_tile(seriesnum,levelnum,pagenum,tile_index,reduce)
+            if np_tile is None:
+                missing.append(tile_index)
+            else:
+                on_tile(tile_index, np_tile)
+        if len(missing) == 0:
+            return
+
+        plan = self.accessor._plan_reads(seriesnum,levelnum,pagenum,missing,num_splits=self.max_concurrency)
+        await asyncio.gather(*[self._fetch_and_decode(seriesnum,levelnum,pagenum,rstart,rend,members,reduce,on_tile)
+                               for rstart,rend,members in plan])
+
+    async def get_tile(self,seriesnum,levelnum,pagenum,tile_index,reduce=1,timeout=None):
+        tiles = await self.get_tiles(seriesnum,levelnum,pagenum,[tile_index],reduce=reduce,timeout=timeout)
+        return tiles[tile_index]
+
+    async def get_tiles(self,seriesnum,levelnum,pagenum,tile_index_list,reduce=1,timeout=None):
+        decoded = {}
+        await asyncio.wait_for(self._visit_tiles(seriesnum,levelnum,pagenum,tile_index_list,reduce,decoded.__setitem__), timeout)
+
+        out_tiles = {}
+        for tile_index in tile_index_list:
+            out_tiles[tile_index] = _writable(decoded[tile_index])
+        return out_tiles
+
+    async def get_region(self,seriesnum,levelnum,pagenum,left,top,width,height,out=None,reduce=1,timeout=None):
+        """ see PyrTifAccessor.get_region """
+        left, top, width, height = reduce_region(left, top, width, height, reduce)
+        out, region_tile_indices = self.accessor._prepare_region(seriesnum,levelnum,pagenum,left,top,width,height,out,reduce)
 
-            row_tile_indices = []
-            for x_tile in range(x_tile_start, x_tile_end + 1):
-                tile_index = y_tile * tiles_per_row + x_tile
-                row_tile_indices.append(tile_index)
-            
-            row_tiles = self.get_tiles(seriesnum,levelnum,pagenum,row_tile_indices)
-            tile_rows.append(np.hstack([row_tiles[tile_index] for tile_index in row_tile_indices])) # mosaic row_tiles
+        def paste(tile_index, np_tile):
+            self.accessor._paste_tile(seriesnum,levelnum,pagenum,out,left,top,tile_index,np_tile,reduce)
 
-        full_region = np.vstack(tile_rows) # mosaic tile_rows
+        await asyncio.wait_for(self._visit_tiles(seriesnum,levelnum,pagenum,region_tile_indices,reduce,paste), timeout)
+        return out
 
-        offset_x = left - (x_tile_start * tile_width)
-        offset_y = top - (y_tile_start * tile_height)
-        roi = full_region[offset_y:offset_y + height, offset_x:offset_x + width]
+    async def get_page(self,seriesnum,levelnum,pagenum,reduce=1,timeout=None):
+        if self.accessor.is_tiled_jpeg(seriesnum,levelnum,pagenum):
+            info = self.get_info(seriesnum,levelnum,pagenum)
+            return await self.get_region(seriesnum,levelnum,pagenum,0,0,info['imagewidth'],info['imagelength'],
+                                         reduce=reduce,timeout=timeout)
+        assert reduce == 1, "reduced decoding requires tiled jpeg pages"
 
-        return roi
\ No newline at end of file
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(None, self.accessor.get_page, seriesnum,levelnum,pagenum), timeout)
\ No newline at end of file
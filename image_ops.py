@@ -38,4 +38,50 @@ def crop_or_pad(arr, roi):
     arr_padded = np.pad(arr,padvalues,constant_values=255)
     
     return arr_padded[r1:r2,c1:c2,...]
-    
\ No newline at end of file
+    
+
+
+def block_mean_downsample(arr, factor, chunk_rows=256):
+    # arr: np.ndarray (H,W) or (H,W,C), integer or float
+    # factor: integer reduction, e.g. a power of two
+    # returns the mean of each factor x factor block, shape (H//factor, W//factor[, C]);
+    # trailing rows/cols that do not fill a block are dropped
+
+    if factor == 1:
+        return arr
+
+    out_h = arr.shape[0]//factor
+    out_w = arr.shape[1]//factor
+    out = np.empty((out_h, out_w) + arr.shape[2:], arr.dtype)
+
+    # integer images are summed in a wider int type and rounded, floats in float64
+    # (uint16 is enough for uint8 blocks of up to 16x16 pixels)
+    nsamples = factor*factor
+    integer = np.issubdtype(arr.dtype, np.integer)
+    if arr.dtype == np.uint8 and nsamples <= 256:
+        acc_dtype = np.uint16
+    elif integer:
+        acc_dtype = np.int64
+    else:
+        acc_dtype = np.float64
+
+    # a chunk of output rows at a time, so the wide accumulator stays small;
+    # strided adds over the block offsets are much faster than a reshape + sum over axes
+    for r1 in range(0, out_h, chunk_rows):
+        r2 = min(r1+chunk_rows, out_h)
+        blk = arr[r1*factor:r2*factor, :out_w*factor]
+
+        rowsums = blk[0::factor].astype(acc_dtype)
+        for ii in range(1, factor):
+            rowsums += blk[ii::factor]
+
+        sums = rowsums[:, 0::factor].copy()
+        for jj in range(1, factor):
+            sums += rowsums[:, jj::factor]
+
+        if integer:
+            out[r1:r2] = (sums + nsamples//2)//nsamples
+        else:
+            out[r1:r2] = sums/nsamples
+    
+    return out
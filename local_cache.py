@@ -0,0 +1,43 @@
+import os
+import hashlib
+import threading
+
+# local cache for data derived from the remote dataset (tif metadata, annotations, ...)
+# override the location with the DHARANI_CACHE_DIR environment variable
+
+CACHE_DIR = os.environ.get('DHARANI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'dharani'))
+
+
+def get_cache_dir(subdir:str):
+    """ returns (and creates) CACHE_DIR/subdir """
+    path = os.path.join(CACHE_DIR, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_key(*parts):
+    """ stable hex key for a tuple of parts, e.g. (url, etag) """
+    hsh = hashlib.sha1('|'.join([str(p) for p in parts]).encode('utf-8'))
+    return hsh.hexdigest()
+
+
+def get_etag(fs, path:str):
+    """ version tag of a remote object: ETag on s3/http, size+mtime otherwise """
+    fs.invalidate_cache(path) # not from a (possibly stale) cached listing
+    info = fs.info(path)
+    for k in ('ETag', 'etag'):
+        if k in info:
+            return str(info[k]).strip('"')
+    return '%s-%s' % (info.get('size'), info.get('mtime', info.get('LastModified')))
+
+
+def atomic_save(path:str, writefn):
+    """ write via a temporary file + rename, so that concurrent readers never see partial files """
+    tmppath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident()) # unique per process and thread
+    try:
+        with open(tmppath, 'wb') as fp:
+            writefn(fp)
+        os.replace(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
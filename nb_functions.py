@@ -7,7 +7,7 @@ import shapely
 
 from typing import Dict, List
 from ontology_handling import TreeHelper
-from annotation_handling import get_reachable_parents, get_supershape
+from annotation_handling import get_reachable_parents, get_supershapes
 
 Annotation = Dict[int,shapely.Geometry]
 
@@ -65,12 +65,13 @@ def display_annotation(im_arr, annot:'Annotation', ontohelper:'TreeHelper', sele
         plt.subplot(1,nplots,3)
         plt.imshow(im_arr)
 
+        supershapes = get_supershapes(annot, ontohelper)
         for ontoid in ontoids:
             if ontoid in annot:
                 shp = annot[ontoid]
                 
             else:
-                shp,chlist = get_supershape(ontoid, annot, ontohelper)
+                shp,chlist = supershapes.get_supershape(ontoid)
                 superannot[ontoid]=shp
 
             rec = ontohelper.onto_lookup[ontoid]
@@ -1,30 +1,291 @@
 import json
+import os
+import time
 import s3fs
-from collections import defaultdict, namedtuple
 import requests
+from collections import defaultdict, namedtuple
+import numpy as np
 
-from rapidfuzz.process import extract as fuzzy_similarity
+import bisect
+from functools import lru_cache
+from rapidfuzz.process import cdist, extract
 from rapidfuzz import fuzz
 
+from local_cache import get_cache_dir, cache_key, get_etag, atomic_save
+from http_client import http_get, ALLEN_API_URL, DEFAULT_MAX_AGE
+
 
 NodeRecord = namedtuple('NodeRecord','acronym,name,color_hex_triplet,level,parentid,numchildren')
 
+ONTOLOGY_ARRAYS = ['ids','parent','level','subtree_end','child_offsets','child_index',
+                   'acronym','name','color','strings','string_offsets']
+
+def ontology_arrays_from_treenom(treenom:list):
+    """
+    compact, array-backed form of a nested ontology tree, all arrays in preorder (node index i):
+
+    ids[i], parent[i] (node index, -1 for roots), level[i], subtree_end[i] (exclusive),
+    children of i: child_index[child_offsets[i]:child_offsets[i+1]],
+    acronym[i], name[i], color[i]: indices into the interned string table
+    (utf-8 'strings' blob, string k is strings[string_offsets[k]:string_offsets[k+1]])
+    """
+    ids, parent, level, subtree_end, children = [], [], [], [], []
+    acronym, name, color = [], [], []
+    interned = {}
+
+    def intern(string):
+        return interned.setdefault(string, len(interned))
+
+    def dft(elt, lvl, parentidx):
+        idx = len(ids)
+        ids.append(int(elt['id']))
+        parent.append(parentidx)
+        level.append(lvl)
+        subtree_end.append(-1)
+        children.append([])
+        acronym.append(intern(elt['acronym']))
+        name.append(intern(elt['name']))
+        color.append(intern(elt['color_hex_triplet']))
+        if parentidx >= 0:
+            children[parentidx].append(idx)
+
+        for child in elt.get('children', []):
+            dft(child, lvl+1, idx)
+        subtree_end[idx] = len(ids)
+
+    for elt in treenom:
+        dft(elt, 0, -1)
+
+    encoded = [string.encode('utf-8') for string in interned]
+    return {
+        'ids': np.array(ids, dtype=np.int64),
+        'parent': np.array(parent, dtype=np.int32),
+        'level': np.array(level, dtype=np.int16),
+        'subtree_end': np.array(subtree_end, dtype=np.int32),
+        'child_offsets': np.cumsum([0]+[len(ch) for ch in children], dtype=np.int32),
+        'child_index': np.array([idx for ch in children for idx in ch], dtype=np.int32),
+        'acronym': np.array(acronym, dtype=np.int32),
+        'name': np.array(name, dtype=np.int32),
+        'color': np.array(color, dtype=np.int32),
+        'strings': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'string_offsets': np.cumsum([0]+[len(enc) for enc in encoded], dtype=np.int64),
+    }
+
+
+def save_ontology(dirpath:str, arrays:dict, treenom:list):
+    """ one .npy per array + the raw tree as json, written last as completion marker """
+    os.makedirs(dirpath, exist_ok=True)
+    for key in ONTOLOGY_ARRAYS:
+        atomic_save(os.path.join(dirpath, key+'.npy'), lambda fp: np.save(fp, arrays[key]))
+    atomic_save(os.path.join(dirpath, 'treenom.json'), lambda fp: fp.write(json.dumps(treenom).encode('utf-8')))
+
+
+def load_ontology_arrays(dirpath:str, mmap=False):
+    """ arrays saved by save_ontology (mmap: memory-mapped, read-only), None if there are none """
+    if not os.path.exists(os.path.join(dirpath, 'treenom.json')):
+        return None
+    return {key:np.load(os.path.join(dirpath, key+'.npy'), mmap_mode='r' if mmap else None) 
+            for key in ONTOLOGY_ARRAYS}
+
+
+DHARANI_ONTOLOGY_PATH = 'dharani-fetal-brain-atlas/ontology/ontology.json'
+ALLEN_ONTOLOGY_URL = '/api/v2/structure_graph_download/16.json'
+
+def _open_treenom(ontoname:str, check_version=True):
+    """
+    (version of the source (ETag, None if not checked), function returning the list of root nodes,
+    function releasing the source)
+    """
+    if ontoname == 'dharani':
+        s3 = s3fs.S3FileSystem(anon=True)
+        def load():
+            with s3.open(DHARANI_ONTOLOGY_PATH) as fp:
+                return json.load(fp)['msg'][0]['children']
+        return (get_etag(s3, DHARANI_ONTOLOGY_PATH) if check_version else None), load, lambda: None
+
+    elif ontoname=='allen_devhuman':
+        response = http_get(ALLEN_API_URL + ALLEN_ONTOLOGY_URL, stream=True) # body read only if loaded
+        def load():
+            with response:
+                return response.json()['msg'][0]['children'][0]['children']
+        return response.version, load, response.close
+
+    raise ValueError(f'unknown ontology {ontoname}')
+
+
+def _version_path(ontoname:str):
+    return os.path.join(get_cache_dir(os.path.join('ontology', ontoname)), 'version.json')
+
+def _known_version(ontoname:str):
+    """ {'version', 'time'} of the last check of the source, None if never checked """
+    if not os.path.exists(_version_path(ontoname)):
+        return None
+    with open(_version_path(ontoname)) as fp:
+        return json.load(fp)
+
+
+class OntologySearch:
+    """
+    Fuzzy search over ontology names (+ exact/prefix search over acronyms), with the same results as
+    rapidfuzz.process.extract over the name dict, but:
+    - candidates for fuzz.ratio are shortlisted by length and character histogram bounds (exact, see _shortlist)
+    - batches of queries are scored with rapidfuzz.process.cdist
+    - recent queries are memoized
+    """
+
+    def __init__(self, names:dict, acronyms:dict=None, memo_size=1024):
+        """ names: id: name, acronyms: id: acronym """
+        self.ids = list(names)
+        self.names = [self.normalize(names[k]) for k in self.ids]
+        self.lengths = np.array([len(nm) for nm in self.names])
+
+        # character histograms of names, code 0 for characters outside the vocabulary
+        self.charcodes = {ch:code+1 for code,ch in enumerate(sorted(set(''.join(self.names))))}
+        self.charhist = np.zeros((len(self.names), len(self.charcodes)+1), dtype=np.uint8)
+        for idx, nm in enumerate(self.names):
+            for ch in nm:
+                self.charhist[idx, self.charcodes[ch]] += 1
+
+        # sorted (normalized name or acronym, id) for prefix completion
+        acronyms = acronyms or {}
+        self.acronyms = {}
+        for ontoid, acro in acronyms.items():
+            self.acronyms.setdefault(self.normalize(acro), ontoid)
+        self.prefix_index = sorted([(nm, ontoid) for nm, ontoid in zip(self.names, self.ids)] + 
+                                   [(acro, ontoid) for acro, ontoid in self.acronyms.items()])
+        self.prefix_keys = [elt[0] for elt in self.prefix_index]
+
+        self._search_memo = lru_cache(maxsize=memo_size)(self._search)
+
+    @staticmethod
+    def normalize(text:str):
+        return text.lower()
+
+    def _shortlist(self, query:str, score_cutoff:float):
+        """
+        indices of names that can reach fuzz.ratio >= score_cutoff with query:
+        ratio = 100*(1 - indel/(lq+ln)), and indel >= |lq-ln| (length bound) and indel >= L1 distance 
+        of the character histograms (checked on the length bound survivors only)
+        """
+        lq = len(query)
+        maxindel = np.floor((1-score_cutoff/100)*(lq+self.lengths) + 1e-9)
+        cands = np.flatnonzero(np.abs(self.lengths-lq) <= maxindel)
+
+        qhist = np.zeros(self.charhist.shape[1], dtype=np.int16)
+        for ch in query:
+            qhist[self.charcodes.get(ch, 0)] += 1
+        dist = np.abs(self.charhist[cands].astype(np.int16) - qhist).sum(axis=1)
+        return cands[dist <= maxindel[cands]]
+
+    def _extract(self, queries:list, scorer, score_cutoff:float, limit, shortlist=False):
+        """ per query [(name, score, id)], sorted by score (then by ontology order) as process.extract """
+        if len(queries)==1:
+            # cdist setup dominates for a single query
+            idxs = self._shortlist(queries[0], score_cutoff) if shortlist else None
+            choices = self.names if idxs is None else [self.names[i] for i in idxs]
+            ret = extract(queries[0], choices, scorer=scorer, score_cutoff=score_cutoff, limit=limit)
+            if idxs is not None:
+                return [[(nm, score, self.ids[idxs[i]]) for nm,score,i in ret]]
+            return [[(nm, score, self.ids[i]) for nm,score,i in ret]]
+
+        out = []
+        scores = cdist(queries, self.names, scorer=scorer, score_cutoff=score_cutoff, dtype=np.float64, workers=-1)
+        for row in scores:
+            hits = np.flatnonzero(row >= score_cutoff)
+            hits = hits[np.lexsort((hits, -row[hits]))][:limit]
+            out.append([(self.names[h], float(row[h]), self.ids[h]) for h in hits])
+        return out
+
+    def search(self, searchstr:str, partial=False, num_results=5):
+        """ see TreeHelper.search """
+        if num_results is not None and num_results < 0:
+            num_results = None
+        return list(self._search_memo(searchstr, partial, num_results))
+
+    def search_many(self, searchstrs:list, partial=False, num_results=5):
+        """ search for a batch of queries, each pass scored in a single cdist call """
+        if num_results is not None and num_results < 0:
+            num_results = None
+        queries = [self.normalize(q) for q in searchstrs]
+        scorer = fuzz.partial_token_sort_ratio if partial else fuzz.ratio
+        rets = self._extract(queries, scorer, 85, num_results)
+        
+        if not partial:
+            rets = [self._exact_only(ret) for ret in rets]
+            retry = [qi for qi,ret in enumerate(rets) if len(ret)==0]
+            if len(retry) > 0:
+                for qi, ret in zip(retry, self._extract([queries[qi] for qi in retry], fuzz.token_ratio, 90, 5)):
+                    rets[qi] = ret
+
+        retry = [qi for qi,ret in enumerate(rets) if len(ret)==0]
+        if len(retry) > 0:
+            for qi, ret in zip(retry, self._extract([queries[qi] for qi in retry], fuzz.partial_token_sort_ratio, 90, 5)):
+                rets[qi] = ret
+
+        return [self._filter_of(searchstr, ret) for searchstr, ret in zip(searchstrs, rets)]
+
+    def _search(self, searchstr:str, partial:bool, num_results):
+        query = self.normalize(searchstr)
+        if partial:
+            ret = self._extract([query], fuzz.partial_token_sort_ratio, 85, num_results)[0]
+        else:
+            ret = self._exact_only(self._extract([query], fuzz.ratio, 85, num_results, shortlist=True)[0])
+            if len(ret)==0:
+                ret = self._extract([query], fuzz.token_ratio, 90, 5)[0]
+
+        if len(ret)==0:
+            ret = self._extract([query], fuzz.partial_token_sort_ratio, 90, 5)[0]
+
+        return tuple(self._filter_of(searchstr, ret))
+
+    @staticmethod
+    def _exact_only(ret):
+        for elt in ret:
+            if elt[1]==100:
+                return [elt] # suppress other elts
+        return ret
+
+    @staticmethod
+    def _filter_of(searchstr, ret):
+        if ' of ' not in searchstr:
+            ret = [elt for elt in ret if ' of ' not in elt[0]]
+        return ret
+
+    def search_acronym(self, acronym:str):
+        """ id for an acronym (case insensitive), None if not found """
+        return self.acronyms.get(self.normalize(acronym))
+
+    def complete(self, prefix:str, num_results=10):
+        """ autocompletion: [(name or acronym, id)] starting with prefix, alphabetical, one per id """
+        prefix = self.normalize(prefix)
+        out, seen = [], set()
+        for i in range(bisect.bisect_left(self.prefix_keys, prefix), len(self.prefix_keys)):
+            key, ontoid = self.prefix_index[i]
+            if not key.startswith(prefix) or len(out)==num_results:
+                break
+            if ontoid not in seen:
+                seen.add(ontoid)
+                out.append((key, ontoid))
+        return out
+
+
 class TreeHelper:
     """
     Abstracts ontology tree reading, searching and navigation for Dharani and Allen nomenclature
     """
 
-    def __init__(self, ontoname='dharani'):
-        """ ontoname: ['dharani', 'allen_devhuman'] """
-
-        if ontoname == 'dharani':
-            s3 = s3fs.S3FileSystem(anon=True)
-            with s3.open('dharani-fetal-brain-atlas/ontology/ontology.json') as fp:
-                self.treenom = json.load(fp)['msg'][0]['children']
+    def __init__(self, ontoname='dharani', treenom=None, use_cache=True, refresh=False, max_age=DEFAULT_MAX_AGE):
+        """ 
+        ontoname: ['dharani', 'allen_devhuman'] 
+        treenom: optional, already loaded list of root nodes (skips the download)
 
-        elif ontoname=='allen_devhuman':
-            allenonto = requests.get('http://api.brain-map.org/api/v2/structure_graph_download/16.json').json()
-            self.treenom = allenonto['msg'][0]['children'][0]['children']
+        use_cache: the ontology is kept locally in array form (see ontology_arrays_from_treenom), keyed by 
+                   the ETag of its source, so that later constructions skip the download and the json parsing;
+                   the nested treenom is only loaded when accessed
+        max_age: seconds the local copy is used without contacting the source, then its ETag is checked again
+                 (None: check every time); when the source cannot be reached the last local copy is used
+        refresh: download again and overwrite the local copy
+        """
 
         # self.flatnom = json.load(open('flatnom_189.json'))['msg'][0]['children']
         
@@ -44,34 +305,86 @@ class TreeHelper:
             'Ctx':['Ctx','FGM'] # fallback cortex 
         }
 
-        self.subtrees = {k:[] for k in self.groups}
-
-        self.onto_lookup:dict[int,NodeRecord] = {} # id:(acronym,name,level,parentid,color_hex_triplet)
-
-        self.ontoids_by_group:dict[str,list] = {k:[] for k in self.groups}
-
-        for elt in self.treenom:
-            self._find_subtrees(elt)
-
-            if 'text' not in elt:
-                elt['text']=elt['acronym'] + ' : ' + elt['name']
-            
-            numchildren = 0
-            if 'children' in elt:
-                numchildren =len(elt['children'])
-            self.onto_lookup[int(elt['id'])]=NodeRecord(elt['acronym'],elt['name'],'#'+elt['color_hex_triplet'],0,0,numchildren)
-            if 'children' in elt:
-                for child in elt['children']:
-                    self._dft(child,1,int(elt['id']))
+        self._treenom = None
+        self._nodes:dict[int,dict] = None # id: node in treenom, built with treenom
+        self._treenom_path = None
+
+        arrays = None
+        known = None
+        if treenom is None and use_cache and not refresh:
+            known = _known_version(ontoname)
+            if known is not None and max_age is not None and time.time() - known['time'] < max_age:
+                arrays = load_ontology_arrays(self._local_copy_dir(ontoname, known['version'])) # no network access
+
+        if treenom is None and arrays is None:
+            try:
+                version, load, release = _open_treenom(ontoname, check_version=use_cache)
+            except (OSError, requests.ConnectionError):
+                if known is not None: # offline: last local copy
+                    arrays = load_ontology_arrays(self._local_copy_dir(ontoname, known['version']))
+                if arrays is None:
+                    raise
+            else:
+                self._treenom_path = None
+                if use_cache and version:
+                    cachedir = self._local_copy_dir(ontoname, version)
+                    if not refresh:
+                        arrays = load_ontology_arrays(cachedir)
+                    atomic_save(_version_path(ontoname), 
+                                lambda fp: fp.write(json.dumps({'version':version, 'time':time.time()}).encode('utf-8')))
+                if arrays is not None:
+                    release()
+                else:
+                    treenom = load()
+
+        if arrays is None:
+            arrays = ontology_arrays_from_treenom(treenom)
+            if self._treenom_path is not None:
+                save_ontology(os.path.dirname(self._treenom_path), arrays, treenom)
+            self._set_treenom(treenom)
+
+        self.arrays = arrays
+        self._index_arrays()
 
         # for elt in self.flatnom:
         #     if elt['id'] not in self.onto_lookup:
         #         self.onto_lookup[elt['id']]=(elt['acronym'],elt['name'],-1,-1)
 
         self.search_dict = {k:v.name.lower() for k,v in self.onto_lookup.items()}
+        self.searcher = OntologySearch(self.search_dict, {k:v.acronym for k,v in self.onto_lookup.items()})
     
     def __len__(self):
         return len(self.onto_lookup)
+
+    def _local_copy_dir(self, ontoname, version):
+        cachedir = get_cache_dir(os.path.join('ontology', ontoname, cache_key(version)))
+        self._treenom_path = os.path.join(cachedir, 'treenom.json')
+        return cachedir
+
+    @property
+    def treenom(self):
+        """ nested ontology tree (list of root nodes), loaded on first access when built from the local copy """
+        if self._treenom is None:
+            with open(self._treenom_path) as fp:
+                self._set_treenom(json.load(fp))
+        return self._treenom
+
+    @property
+    def subtrees(self):
+        """ group name: [root nodes of the group in treenom] """
+        self.treenom
+        return {grp:[self._nodes[ontoid] for ontoid in rootids] for grp,rootids in self._subtree_ids.items()}
+
+    def _set_treenom(self, treenom):
+        self._treenom = treenom
+        self._nodes = {}
+        stack = list(treenom)
+        while len(stack) > 0:
+            elt = stack.pop()
+            if 'text' not in elt:
+                elt['text']=elt['acronym'] + ' : ' + elt['name']
+            self._nodes[int(elt['id'])] = elt
+            stack.extend(elt.get('children', []))
     
     def _get_node_data(self,elt):
         outdict={}
@@ -80,37 +393,71 @@ class TreeHelper:
                 outdict[k]=v
         return outdict
     
-    def _dft(self, elt, level, parentid):
-        
-        if 'text' not in elt:
-            elt['text']=elt['acronym'] + ' : ' + elt['name']
-        
-        numchildren = 0
-        if 'children' in elt:
-            numchildren =len(elt['children'])
-        self.onto_lookup[int(elt['id'])]=NodeRecord(elt['acronym'],elt['name'],'#'+elt['color_hex_triplet'],level,parentid,numchildren)
-
-        if 'children' in elt:
-            for child in elt['children']:
-                self._dft(child,level+1,int(elt['id']))
-        
+    def _index_arrays(self):
+        """
+        python lookup indexes (onto_lookup, nested set, children, groups, ...) rebuilt from the arrays at every
+        construction; the arrays are the storage format of the local copy, lookups do not read from them
+        """
+        arrays = self.arrays
+        blob = arrays['strings'].tobytes()
+        offsets = arrays['string_offsets'].tolist()
+        strings = [blob[offsets[k]:offsets[k+1]].decode('utf-8') for k in range(len(offsets)-1)]
+
+        ids = arrays['ids'].tolist()
+        parent = arrays['parent'].tolist()
+        level = arrays['level'].tolist()
+        subtree_end = arrays['subtree_end'].tolist()
+        child_offsets = arrays['child_offsets'].tolist()
+        acronym = arrays['acronym'].tolist()
+        name = arrays['name'].tolist()
+        color = arrays['color'].tolist()
+
+        self.onto_lookup:dict[int,NodeRecord] = {} # id:(acronym,name,level,parentid,color_hex_triplet)
+
+        # nested set index: preorder position of each id, and the end (exclusive) of its subtree,
+        # so descendants of an id are self._preorder[self._pre[id]+1:self._end[id]]
+        self._preorder:list[int] = ids
+        self._pre:dict[int,int] = {}
+        self._end:dict[int,int] = {}
+        self._ancestors:dict[int,tuple] = {} # id: ancestor ids, general to specialized
+
+        # navigation indexes
+        self._children:dict[int,list] = {0:[]} # id: child ids, 0: root ids
+        self._id_by_acronym:dict[str,int] = {}
+        self._ids_by_level:dict[int,list] = defaultdict(list)
+
+        self.ontoids_by_group:dict[str,list] = {k:[] for k in self.groups}
+        self._subtree_ids:dict[str,list] = {k:[] for k in self.groups} # group: root ids of its subtrees
+        grp_by_acronym = {acro:grp for grp,acros in reversed(list(self.groups.items())) for acro in acros}
+        grpctx = [None]*len(ids) # group a node belongs to through its ancestors
+
+        for idx, ontoid in enumerate(ids):
+            paridx = parent[idx]
+            parentid = ids[paridx] if paridx >= 0 else 0
+            acro = strings[acronym[idx]]
+
+            self.onto_lookup[ontoid]=NodeRecord(acro,strings[name[idx]],'#'+strings[color[idx]],level[idx],parentid,
+                                                child_offsets[idx+1]-child_offsets[idx])
+
+            self._pre[ontoid] = idx
+            self._end[ontoid] = subtree_end[idx]
+            self._ancestors[ontoid] = self._ancestors[parentid]+(parentid,) if paridx >= 0 else ()
+            self._children[parentid].append(ontoid)
+            self._children[ontoid] = []
+            self._id_by_acronym.setdefault(acro, ontoid)
+            self._ids_by_level[level[idx]].append(ontoid)
+
+            # group membership: a group root belongs to its own and its enclosing group,
+            # its descendants to its own group only
+            foundgrp = grp_by_acronym.get(acro)
+            enclosing = grpctx[paridx] if paridx >= 0 else None
+            if foundgrp is not None:
+                self._subtree_ids[foundgrp].append(ontoid)
+                self.ontoids_by_group[foundgrp].append(ontoid)
+            if enclosing is not None:
+                self.ontoids_by_group[enclosing].append(ontoid)
+            grpctx[idx] = foundgrp or enclosing
 
-    def _find_subtrees(self,elt, grprootname=None):
-        foundgrp=self._check_node(elt)
-        if foundgrp is not None:
-            self.ontoids_by_group[foundgrp].append(elt['id'])
-        if grprootname is not None:
-            self.ontoids_by_group[grprootname].append(elt['id'])
-        if 'children' in elt:
-            for child in elt['children']:
-                self._find_subtrees(child, foundgrp or grprootname)
-
-    def _check_node(self,elt):
-        for grpname, grpparents in self.groups.items():
-            if elt['acronym'] in grpparents:
-                self.subtrees[grpname].append(elt)
-                return grpname
-        return None            
     # def get_group_by_acronym(self, rgnname):
     #     for grpname in self.subtrees:
     #         for subtr in self.subtrees[grpname]:
@@ -145,14 +492,19 @@ class TreeHelper:
               
     def get_ancestor_ids(self, ontoid:int):
         """get a list of ancestor ids, general to specialized"""
-        idlist = []
         if ontoid>0:
-            lastrec = self.onto_lookup[ontoid]
-            while lastrec.parentid != 0:
-                idlist.append(lastrec.parentid)
-                lastrec = self.onto_lookup[lastrec.parentid]
+            return list(self._ancestors[ontoid])
+        return []
 
-        return list(reversed(idlist))
+    def is_ancestor(self, ancid:int, ontoid:int):
+        """True if ancid is a (strict) ancestor of ontoid, O(1)"""
+        if ancid not in self._pre or ontoid not in self._pre:
+            return False
+        return self._pre[ancid] < self._pre[ontoid] < self._end[ancid]
+
+    def get_descendant_ids(self, ontoid:int):
+        """all ids in the subtree below ontoid, in preorder"""
+        return self._preorder[self._pre[ontoid]+1:self._end[ontoid]]
     
     def get_full_name_by_ontoid(self,ontoid:int):
         anclist = self.get_ancestor_ids(ontoid)
@@ -166,62 +518,30 @@ class TreeHelper:
         return fullname[:-1], fullacro[:-1] # skip trailing /
     
     def _get_node_by_ontoid(self,ontoid:int):
-        ancestorids = self.get_ancestor_ids(ontoid)
-        ancnode = None
-        
-        for elt in self.treenom:
-            # print(elt['id'])
-            if elt['id'] in ancestorids:
-                ancnode = elt
-                break
-
-        # traverse ancestors from root down, to get the parentnode
-        node = None
-        while node is None:
-            # print(ancnode['id'])
-            if 'children' in ancnode:
-                for ch in ancnode['children']:
-                    if ch['id'] in ancestorids:
-                        ancnode = ch 
-                    elif ch['id']==ontoid:
-                        node = ch
-                        break
-            else:
-                break
-
-        return node
+        self.treenom
+        return self._nodes.get(ontoid)
 
     def get_children_ids(self, ontoid:int):
-        nd = self._get_node_by_ontoid(ontoid)
-        if 'children' in nd:
-            return [int(ch['id']) for ch in nd['children']]
-        return []
+        return list(self._children[ontoid])
 
     def get_sibling_ids(self,ontoid:int):
         
         parentid = self.onto_lookup[ontoid].parentid
-        parentnode = self._get_node_by_ontoid(parentid)
-
-        siblingids = [int(elt['id']) for elt in parentnode['children']]
-        
-        return siblingids
+        return list(self._children[parentid])
     
 
     def get_group_by_ontoid(self, ontoid:int):
 
         ancestorids = self.get_ancestor_ids(ontoid)
-        for grpname in self.subtrees:
-            for subtr in self.subtrees[grpname]:
-                if subtr['id'] in ancestorids or subtr['id']==ontoid:
+        for grpname in self._subtree_ids:
+            for rootid in self._subtree_ids[grpname]:
+                if rootid in ancestorids or rootid==ontoid:
                     return grpname
         
         return None
     
     def _get_id_by_acronym(self,acro:str):
-        for id, rec in self.onto_lookup.items():
-            if acro == rec.acronym:
-                return id
-        return None
+        return self._id_by_acronym.get(acro)
     
     def get_group_by_acronym(self, acro:str):
         ontoid = self._get_id_by_acronym(acro)
@@ -254,12 +574,7 @@ class TreeHelper:
 
 
     def get_ids_by_level(self,level:int):
-        idlist = []
-        for id,rec in self.onto_lookup.items():
-            if rec.level==level:
-                idlist.append(id)
-
-        return idlist
+        return list(self._ids_by_level.get(level, []))
 
     def get_ids_of_cortical_areas(self):
         idlist = defaultdict(list)
@@ -297,31 +612,16 @@ class TreeHelper:
 
     def search(self, searchstr, partial=False, num_results=5):
         # set num_results to -1 for no limit
-        query = searchstr.lower() # .replace(',', ' in')
-        scorer = fuzz.ratio
-        if partial:
-            scorer=fuzz.partial_token_sort_ratio
-        ret = fuzzy_similarity(query, self.search_dict, scorer=scorer, score_cutoff=85, limit=num_results)
+        # returns [(name, score, id)]
+        return self.searcher.search(searchstr, partial, num_results)
 
-        if not partial:
-            for elt in ret:
-                if elt[1]==100:
-                    ret = [elt] # suppress other elts
-                    break
-        if len(ret)==0 and not partial:
-            ret = fuzzy_similarity(query, self.search_dict, scorer=fuzz.token_ratio, score_cutoff=90, limit=5)
-        
-        if len(ret)==0:
-            ret = fuzzy_similarity(query, self.search_dict, scorer=fuzz.partial_token_sort_ratio, score_cutoff=90, limit=5)
-
-        if ' of ' not in searchstr:
-
-            out = []
-            for elt in ret:                
-                if ' of ' not in elt[0]:
-                    out.append(elt)
-            
-            ret = out
+    def search_many(self, searchstrs:list, partial=False, num_results=5):
+        return self.searcher.search_many(searchstrs, partial, num_results)
+    
+    def search_acronym(self, acronym:str):
+        # exact acronym lookup (case insensitive), returns id or None
+        return self.searcher.search_acronym(acronym)
 
-        return ret
-    
\ No newline at end of file
+    def complete(self, prefix:str, num_results=10):
+        # names and acronyms starting with prefix, returns [(name or acronym, id)]
+        return self.searcher.complete(prefix, num_results)